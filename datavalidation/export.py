@@ -0,0 +1,164 @@
+'''
+Bulk output of recognized passports: JSON Lines, CSV and Parquet.
+
+Every writer takes `PassportData` records one by one and writes them as they come, along with
+optional extra columns given when the writer is created (e.g. the file name of the scan):
+
+    with open_writer("passports.csv", extra=("file",)) as writer:
+        for path, data in results:
+            writer.write(data, file=path)
+
+The columns are the `PassportData.ATTRIBUTES`, then `<attribute>_confidence` and `<attribute>_source`,
+and "invalid": the attributes that failed their checks, separated by spaces.
+Parquet output needs the pyarrow package.
+
+License: MIT
+'''
+
+import csv
+import io
+import json
+import os
+
+from .passportdata import PassportData
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CONFIDENCE_COLUMNS = tuple(attr + "_confidence" for attr in PassportData.ATTRIBUTES)
+SOURCE_COLUMNS = tuple(attr + "_source" for attr in PassportData.ATTRIBUTES)
+
+
+def columns(extra=()):
+    """The column names of the tabular formats"""
+    return tuple(extra) + PassportData.ATTRIBUTES + CONFIDENCE_COLUMNS + SOURCE_COLUMNS + ("invalid",)
+
+
+def to_row(data, extra=()):
+    """A record as a tuple of `columns(extra)`. `data` may be None, e.g. for a failed scan."""
+    if data is None:
+        return tuple(extra) + (None,) * (3 * len(PassportData.ATTRIBUTES) + 1)
+    return (tuple(extra) + data.to_row() +
+            tuple(data.confidence.get(attr) for attr in PassportData.ATTRIBUTES) +
+            tuple(data.source.get(attr) for attr in PassportData.ATTRIBUTES) +
+            (" ".join(data.invalid),))
+
+
+class Writer(object):
+    """Base class of the writers. Use as a context manager, or call `close` when done."""
+
+    def __init__(self, extra=()):
+        self.extra = tuple(extra)
+        self.count = 0
+        self.file = None  # Closed along with the writer
+
+    def write(self, data, **extra):
+        """Writes a `PassportData` (or None) with the values of the extra columns"""
+        raise NotImplementedError
+
+    def write_all(self, records):
+        """Writes `PassportData` records, returning their number"""
+        for data in records:
+            self.write(data)
+        return self.count
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JSONLinesWriter(Writer):
+    """One JSON object per line: the extra values, "passport data" as saved by `PassportData.to_dict`,
+    "confidence", "source" and "invalid". A None record is written with the extra values only;
+    the extra values that are None are left out."""
+
+    def __init__(self, fp, extra=(), flush=False):
+        super(JSONLinesWriter, self).__init__(extra)
+        self.fp = fp
+        self.flush = flush
+
+    def write(self, data, **extra):
+        record = dict((name, value) for name, value in extra.items() if value is not None)
+        if data is not None:
+            record.update(data.to_dict())
+            record["confidence"] = data.confidence
+            record["source"] = data.source
+            record["invalid"] = data.invalid
+        self.fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if self.flush:
+            self.fp.flush()
+        self.count += 1
+
+
+class CSVWriter(Writer):
+    """CSV with a header row of `columns(extra)`"""
+
+    def __init__(self, fp, extra=()):
+        super(CSVWriter, self).__init__(extra)
+        self.writer = csv.writer(fp)
+        self.writer.writerow(columns(self.extra))
+
+    def write(self, data, **extra):
+        self.writer.writerow(to_row(data, [extra.get(name) for name in self.extra]))
+        self.count += 1
+
+
+class ParquetWriter(Writer):
+    """Parquet file of `columns(extra)`, written in row groups of `batch_size` records.
+    The confidences are doubles, everything else strings."""
+
+    def __init__(self, path, extra=(), batch_size=65536):
+        if pyarrow is None:
+            raise ImportError("Parquet output requires the pyarrow package")
+        super(ParquetWriter, self).__init__(extra)
+        self.batch_size = batch_size
+        self.columns = columns(self.extra)
+        self.schema = pyarrow.schema([(name, pyarrow.float64() if name in CONFIDENCE_COLUMNS else pyarrow.string())
+                                      for name in self.columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.rows = []
+
+    def write(self, data, **extra):
+        row = to_row(data, [extra.get(name) for name in self.extra])
+        self.rows.append(row)
+        self.count += 1
+        if len(self.rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self.rows:
+            # Transpose the buffered rows into columns
+            arrays = [pyarrow.array(column, type=field.type)
+                      for column, field in zip(zip(*self.rows), self.schema)]
+            self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+        super(ParquetWriter, self).close()
+
+
+FORMATS = {'.jsonl': 'jsonl', '.json': 'jsonl', '.csv': 'csv', '.parquet': 'parquet'}
+
+
+def open_writer(path, format=None, extra=()):
+    """Creates a writer for a file, the format given by name (jsonl, csv, parquet) or by the file extension.
+    The file is closed with the writer."""
+    format = format or FORMATS.get(os.path.splitext(path)[1].lower(), 'jsonl')
+    if format == 'parquet':
+        return ParquetWriter(path, extra)
+    fp = io.open(path, "w", encoding='utf-8', newline='' if format == 'csv' else None)
+    writer = CSVWriter(fp, extra) if format == 'csv' else JSONLinesWriter(fp, extra)
+    writer.file = fp
+    return writer
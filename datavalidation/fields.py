@@ -0,0 +1,139 @@
+'''
+Declarative normalization and checks of the passport fields.
+
+Every `PassportData` attribute is described by a `FieldSpec`: the blocks it is read from, how their lines
+are joined, a translation table fixing the usual OCR confusions and separators, and the format the value
+must have. The tables and the regular expressions are compiled once, and a value is normalized and checked
+in a single pass:
+
+    >>> SPECS['code'].normalize("292 OOO")
+    ('292-000', True)
+    >>> SPECS['dataExtradition'].normalize("17,12.2OO4")
+    ('17.12.2004', True)
+    >>> SPECS['dateBirth'].normalize("31.02.1982")
+    ('31.02.1982', False)
+    >>> SPECS['serial'].normalize("11 0")
+    ('110', False)
+    >>> SPECS['male'].normalize("МУЖ")
+    ('МУЖ.', True)
+
+License: MIT
+'''
+
+import datetime
+import re
+
+# Characters that OCR often reads instead of digits, latin and cyrillic
+DIGITS = {'O': '0', 'О': '0', 'Q': '0', 'D': '0', 'I': '1', 'l': '1', '|': '1', 'Z': '2', 'З': '3',
+          'S': '5', 'G': '6', 'Б': '6', 'B': '8', 'В': '8'}
+
+
+def _table(replace=None, delete=""):
+    """A `str.translate` table replacing and deleting characters at once"""
+    table = str.maketrans(replace or {})
+    table.update(str.maketrans("", "", delete))
+    return table
+
+
+def _join(lines):
+    return "".join(lines)
+
+
+def _join_name(lines):
+    return "".join(lines).replace("\n", " ").replace(".", "")
+
+
+def _join_longer(n, ignore="."):
+    """Joins the lines having more than `n` characters besides the `ignore` ones"""
+    table = str.maketrans("", "", ignore)
+    return lambda lines: "".join(line for line in lines if len(line.translate(table)) > n)
+
+
+def _date_exists(value):
+    try:
+        datetime.datetime.strptime(value, "%d.%m.%Y")
+    except ValueError:
+        return False
+    return True
+
+
+class FieldSpec(object):
+    """How a PassportData attribute is read from the document blocks and checked.
+
+    :param blocks: The blocks to read the attribute from, in order of preference.
+    :param join: Makes the value of the lines recognized in a block.
+    :param table: `str.translate` table applied to the value before it is checked.
+    :param pattern: A regular expression the whole value must match. Without one, any value but an empty one is valid.
+    :param format: Makes the normalized value of the match groups. The value is kept as is if None.
+    :param check: Checks the meaning of the normalized value, e.g. that a date exists.
+    """
+
+    __slots__ = ['attr', 'blocks', 'join', 'table', 'pattern', 'format', 'check']
+
+    def __init__(self, attr, blocks, join=_join, table=None, pattern=None, format=None, check=None):
+        self.attr = attr
+        self.blocks = blocks
+        self.join = join
+        self.table = table
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.format = format
+        self.check = check
+
+    def normalize(self, value):
+        """Returns the normalized value and whether it is valid. An invalid value is returned translated,
+        for the operator to correct."""
+        if value is None:
+            return None, False
+        if self.table is not None:
+            value = value.translate(self.table)
+        value = value.strip()
+        if self.pattern is None:
+            return value, bool(value)
+        match = self.pattern.fullmatch(value)
+        if match is None:
+            return value, False
+        if self.format is not None:
+            value = self.format.format(*match.groups())
+        return value, self.check is None or self.check(value)
+
+    def parse(self, lines):
+        """The normalized value of the lines recognized in a block and whether it is valid"""
+        return self.normalize(self.join(lines))
+
+    def __repr__(self):
+        return "FieldSpec(%r, %r)" % (self.attr, self.blocks)
+
+
+_NAME = r"[А-ЯЁ]+(?:[ -]+[А-ЯЁ]+)*"
+_NUMBER = _table(DIGITS, " \n")
+_DATE = _table(dict(DIGITS, **{',': '.', '/': '.', '-': '.'}), " \n")
+_TEXT = _table({'\n': ' '})
+
+# PassportData attribute -> FieldSpec, in the order the fields are read
+SPECS = dict((spec.attr, spec) for spec in [
+    FieldSpec('name', ["Имя"], _join_name, pattern=_NAME),
+    FieldSpec('lastName', ["Фамилия"], _join_name, pattern=_NAME),
+    FieldSpec('midName', ["Отчество"], _join_name, pattern=_NAME),
+    FieldSpec('serial', ["Серия1", "Серия2"], table=_NUMBER, pattern=r"\d{4}"),
+    FieldSpec('number', ["Номер1", "Номер2"], table=_NUMBER, pattern=r"\d{6}"),
+    FieldSpec('dateBirth', ["Дата рождения"], _join_longer(2), _DATE, r"(\d\d)\.*(\d\d)\.*(\d{4})",
+              "{0}.{1}.{2}", _date_exists),
+    FieldSpec('male', ["Пол"], table=_table(delete=" \n"), pattern=r"(МУЖ|ЖЕН)\.?", format="{0}."),
+    FieldSpec('place', ["Место рождения"], _join_longer(2), _TEXT),
+    FieldSpec('placeExtradition', ["Паспорт выдан"], _join_longer(3, " .-"), _TEXT),
+    FieldSpec('dataExtradition', ["Дата выдачи"], _join_longer(2), _DATE, r"(\d\d)\.*(\d\d)\.*(\d{4})",
+              "{0}.{1}.{2}", _date_exists),
+    FieldSpec('code', ["Код подразделения"], table=_table(dict(DIGITS, **{'_': '-', '—': '-'}), " \n"),
+              pattern=r"(\d{3})-?(\d{3})", format="{0}-{1}"),
+])
+
+
+def validate(data):
+    """Normalizes the fields of a PassportData in place, returning the attributes whose values are invalid"""
+    invalid = []
+    for attr, spec in SPECS.items():
+        value, valid = spec.normalize(getattr(data, attr))
+        setattr(data, attr, value)
+        if not valid:
+            invalid.append(attr)
+    return invalid
@@ -12,11 +12,16 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import (QWidget, QHBoxLayout, QLabel, QApplication)
 from PyQt5.QtGui import QPixmap
 import cv2 
+import io
+import itertools
 import sys
-import json
+import threading
+from collections import deque
 
-from pasportrecogniotion.image import recognise_doc
+from pasportrecogniotion.image import MRZPipeline, RecognitionCancelled
+from pasportrecogniotion.util.imagefile import load_image
 from .passportdata import PassportData
+from . import export, fields
 from pkg_resources import resource_filename
 
 
@@ -37,12 +42,106 @@ class DisplayImageWidget(QtWidgets.QWidget):
 
 
 
+class RecognitionSignals(QtCore.QObject):
+    """Signals of RecognitionWorker (QRunnable is not a QObject)"""
+
+    blockRecognized = QtCore.pyqtSignal(int, str, str)  # ticket, block name, block text
+    finished = QtCore.pyqtSignal(int, object)           # ticket, PassportData
+    failed = QtCore.pyqtSignal(int, str)                # ticket, error message
+    cancelled = QtCore.pyqtSignal(int)                  # ticket
+
+
+class RecognitionWorker(QtCore.QRunnable):
+    """Recognizes one passport in a QThreadPool thread, reporting every recognized block.
+    The pipeline is kept in `pipeline`, so that single blocks can be re-run later with `BlockWorker`.
+    The signals carry the queue ticket of the passport, the same picture may be queued more than once."""
+
+    def __init__(self, ticket, image, doc_descr, min_confidence=None):
+        super(RecognitionWorker, self).__init__()
+        self.setAutoDelete(False)
+        self.ticket = ticket
+        self.image = image
+        self.doc_descr = doc_descr
+        self.min_confidence = min_confidence
+        self.pipeline = None
+        self.signals = RecognitionSignals()
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def isCancelled(self):
+        return self._cancel.is_set()
+
+    def run(self):
+        try:
+            self.pipeline = MRZPipeline(self.image, self.doc_descr, progress=self.blockRecognized, cancel=self._cancel,
+                                        min_confidence=self.min_confidence)
+            data = self.pipeline.result
+        except RecognitionCancelled:
+            self.pipeline = None
+            self.signals.cancelled.emit(self.ticket)
+        except Exception as e:
+            self.pipeline = None
+            self.signals.failed.emit(self.ticket, "%s: %s" % (type(e).__name__, e))
+        else:
+            self.signals.finished.emit(self.ticket, data)
+        self.image = None
+
+    def blockRecognized(self, block):
+        self.signals.blockRecognized.emit(self.ticket, block.name, "".join(block.data))
+
+
+class BlockWorker(QtCore.QRunnable):
+    """Re-runs one block of an already recognized passport after the operator corrects its settings"""
+
+    def __init__(self, ticket, pipeline, name, **changes):
+        super(BlockWorker, self).__init__()
+        self.setAutoDelete(False)
+        self.ticket = ticket
+        self.pipeline = pipeline
+        self.name = name
+        self.changes = changes
+        self.signals = RecognitionSignals()
+
+    def run(self):
+        try:
+            data = self.pipeline.update_block(self.name, **self.changes)
+        except Exception as e:
+            self.signals.failed.emit(self.ticket, "%s: %s" % (type(e).__name__, e))
+        else:
+            self.signals.finished.emit(self.ticket, data)
+
+
 class Ui_MainWindow(object):
-    def setupUi(self, MainWindow, pasPicture):
+    def setupUi(self, MainWindow, pasPicture, workers=1, minConfidence=60, resultFile="result2.jsonl"):
+        """
+        :param pasPicture: A passport image file or a list of them. They are recognized in the background
+                           by `workers` threads, in order, and shown for review one after another.
+        :param minConfidence: Blocks recognized with a lower OCR confidence are read once more with
+                              more expensive settings, and the fields still below it are highlighted.
+        :param resultFile: The reviewed passports are appended there, one JSON line each with the picture
+                           file name, see `export.JSONLinesWriter`.
+        """
         MainWindow.setObjectName("MainWindow")
         MainWindow.resize(1100, 560)
 
-        self.picture = pasPicture
+        self.pictures = [pasPicture] if isinstance(pasPicture, str) else list(pasPicture)
+        self.picture = None
+        self.ticket = None     # queue ticket of the shown passport
+        self.data = None
+        self.tickets = itertools.count()
+        self.queue = deque()   # tickets of the passports waiting for review
+        self.names = {}        # ticket -> picture, until it is reviewed
+        self.workers = {}      # ticket -> RecognitionWorker
+        self.results = {}      # ticket -> PassportData, None if the recognition failed
+        self.pipelines = {}    # ticket -> MRZPipeline of the recognized passport, until it is reviewed
+        self.blockWorkers = {} # ticket -> BlockWorker re-running one of its blocks
+        self.images = {}       # ticket -> LazyImage, until it is shown
+        self.threadPool = QtCore.QThreadPool()
+        self.threadPool.setMaxThreadCount(workers)
+        self.minConfidence = minConfidence
+        self.resultFile = resultFile
 
         self.centralwidget = QtWidgets.QWidget(MainWindow)
         self.centralwidget.setObjectName("centralwidget")
@@ -50,12 +149,10 @@ class Ui_MainWindow(object):
         self.serEdit.setGeometry(QtCore.QRect(780, 30, 90, 20))
 
         hbox = QtWidgets.QHBoxLayout(self.centralwidget)
-        pixmap = QtGui.QPixmap(pasPicture)
-        lbl = QtWidgets.QLabel(self.centralwidget)
-        lbl.setPixmap(pixmap)
-        hbox.addWidget(lbl)
+        self.pictureLabel = QtWidgets.QLabel(self.centralwidget)
+        hbox.addWidget(self.pictureLabel)
         self.centralwidget.setLayout(hbox)
-        lbl.move(50, 50)
+        self.pictureLabel.move(50, 50)
 
        
 
@@ -86,6 +183,12 @@ class Ui_MainWindow(object):
         self.exit.setObjectName("exit")
         self.exit.clicked.connect(sys.exit)
 
+        #кнопка отмены распознавания
+        self.cancel = QtWidgets.QPushButton(self.centralwidget)
+        self.cancel.setGeometry(QtCore.QRect(700, 480, 90, 30))
+        self.cancel.setObjectName("cancel")
+        self.cancel.clicked.connect(self.buttonCancelClicked)
+
 
         #
         self.dateEdit_1 = QtWidgets.QLineEdit(self.centralwidget)
@@ -206,10 +309,43 @@ class Ui_MainWindow(object):
         self.statusbar.setObjectName("statusbar")
         MainWindow.setStatusBar(self.statusbar)
 
+        # Поля, заполняемые по мере распознавания блоков
+        self.blockEdits = {
+            "Серия1": self.serEdit,
+            "Номер1": self.numEdit,
+            "Фамилия": self.lastnameEdit,
+            "Имя": self.nameEdit,
+            "Отчество": self.midNameEdit,
+            "Дата рождения": self.dateBirthEdit,
+            "Место рождения": self.placeEdit,
+            "Пол": self.maleEdit,
+            "Паспорт выдан": self.dateEdit_1,
+            "Дата выдачи": self.dateEdit_2,
+            "Код подразделения": self.codeEdit,
+        }
+        # PassportData attribute -> its edit
+        self.fieldEdits = {
+            'serial': self.serEdit,
+            'number': self.numEdit,
+            'lastName': self.lastnameEdit,
+            'name': self.nameEdit,
+            'midName': self.midNameEdit,
+            'dateBirth': self.dateBirthEdit,
+            'place': self.placeEdit,
+            'male': self.maleEdit,
+            'placeExtradition': self.dateEdit_1,
+            'dataExtradition': self.dateEdit_2,
+            'code': self.codeEdit,
+        }
+
         #
         self.retranslateUi(MainWindow)
         QtCore.QMetaObject.connectSlotsByName(MainWindow)
 
+        for picture in self.pictures:
+            self.enqueue(picture)
+        self.showNext()
+
 
        
 
@@ -229,56 +365,175 @@ class Ui_MainWindow(object):
         self.dateLabel_2.setText(_translate("MainWindow", "Дата выдачи"))
         self.codeLabel.setText(_translate("MainWindow", "Код подразделения"))
         self.maleLabel.setText(_translate("MainWindow", "Пол"))
+        self.cancel.setText(_translate("MainWindow", "Отмена"))
 
+    def enqueue(self, picture):
+        """Starts recognizing a passport in the background and queues it for review"""
 
         ## test data
         file = lambda fn: resource_filename('tests', 'data/%s' % fn)
-        self.data = recognise_doc(cv2.imread(self.picture), file("RusPass.json"))
 
-        #Здесь выводится текст
-        self.setEditValidData(self.data)
+        # Decoded by the recognition, and shown from the same buffer
+        try:
+            image = load_image(picture)
+        except IOError:
+            image = None
+        ticket = next(self.tickets)
+        self.names[ticket] = picture
+        self.images[ticket] = image
+        self.queue.append(ticket)
+        if image is None:
+            self.results[ticket] = None
+            return
+
+        worker = RecognitionWorker(ticket, image, file("RusPass.json"), self.minConfidence)
+        worker.signals.blockRecognized.connect(self.onBlockRecognized)
+        worker.signals.finished.connect(self.onRecognized)
+        worker.signals.failed.connect(self.onFailed)
+        worker.signals.cancelled.connect(self.onCancelled)
+        self.workers[ticket] = worker
+        self.threadPool.start(worker)
+
+    def showNext(self):
+        """Shows the next queued passport, with its data if it is already recognized"""
+
+        self.clearEdits()
+        self.data = None
+        if self.ticket is not None:
+            del self.names[self.ticket]
+        if not self.queue:
+            self.picture = self.ticket = None
+            self.pictureLabel.clear()
+            self.statusbar.showMessage("Нет паспортов для проверки")
+            return
+
+        self.ticket = self.queue.popleft()
+        self.picture = self.names[self.ticket]
+        image = self.images.pop(self.ticket)
+        try:
+            image = image.gray if image is not None else None
+        except IOError:
+            image = None
+        if image is None:
+            self.pictureLabel.clear()
+            self.statusbar.showMessage("Не удалось открыть %s" % self.picture)
+            return
+
+        # The grayscale image decoded for the recognition, not loaded once more
+        qimage = QtGui.QImage(image.data, image.shape[1], image.shape[0], image.strides[0],
+                              QtGui.QImage.Format_Grayscale8)
+        self.pictureLabel.setPixmap(QtGui.QPixmap.fromImage(qimage))
+        self.pictureLabel.adjustSize()
+
+        if self.ticket in self.results:
+            self.showResult(self.ticket)
+        else:
+            self.statusbar.showMessage("Распознавание %s..." % self.picture)
+
+    def showResult(self, ticket):
+        picture = self.names[ticket]
+        self.data = self.results[ticket]
+        if self.data is None:
+            self.statusbar.showMessage("Не удалось распознать %s" % picture)
+        else:
+            #Здесь выводится текст
+            self.setEditValidData(self.data)
+            #поля, распознанные неуверенно или не прошедшие проверку
+            for attr in set(self.data.uncertain(self.minConfidence)) | set(self.data.invalid):
+                self.fieldEdits[attr].setStyleSheet("background-color: #ffe0e0")
+            self.statusbar.showMessage("Распознано: %s, в очереди: %d" % (picture, len(self.queue)))
+
+    def onBlockRecognized(self, ticket, name, text):
+        if ticket == self.ticket and name in self.blockEdits:
+            self.blockEdits[name].setText(text.replace("\n", " "))
+            self.statusbar.showMessage("Распознавание %s: %s" % (self.picture, name))
+
+    def onRecognized(self, ticket, data):
+        worker = self.workers.pop(ticket)
+        if worker.isCancelled():
+            return
+        self.results[ticket] = data
+        self.pipelines[ticket] = worker.pipeline
+        if ticket == self.ticket:
+            self.showResult(ticket)
+
+    def onFailed(self, ticket, message):
+        if self.workers.pop(ticket).isCancelled():
+            return
+        self.results[ticket] = None
+        if ticket == self.ticket:
+            self.statusbar.showMessage("Ошибка распознавания %s: %s" % (self.picture, message))
+
+    def rerunBlock(self, name, **changes):
+        """Recognizes one block of the shown passport again with corrected settings, e.g.
+        `rerunBlock("Имя", posX=380)`. Only that block is recognized, in the background."""
+        pipeline = self.pipelines.get(self.ticket)
+        if pipeline is None or self.ticket in self.blockWorkers:
+            return False
+        worker = BlockWorker(self.ticket, pipeline, name, **changes)
+        worker.signals.finished.connect(self.onBlockRerun)
+        worker.signals.failed.connect(self.onBlockRerunFailed)
+        self.blockWorkers[self.ticket] = worker
+        self.statusbar.showMessage("Распознавание %s: %s" % (self.picture, name))
+        self.threadPool.start(worker)
+        return True
+
+    def onBlockRerun(self, ticket, data):
+        del self.blockWorkers[ticket]
+        if ticket in self.pipelines:
+            self.results[ticket] = data
+        if ticket == self.ticket:
+            self.showResult(ticket)
+
+    def onBlockRerunFailed(self, ticket, message):
+        del self.blockWorkers[ticket]
+        if ticket == self.ticket:
+            self.statusbar.showMessage("Ошибка распознавания %s: %s" % (self.picture, message))
+
+    def onCancelled(self, ticket):
+        del self.workers[ticket]
+
+    def buttonCancelClicked(self):
+        """Stops recognizing the shown passport and skips to the next one"""
+        worker = self.workers.get(self.ticket)
+        if worker is not None:
+            if self.threadPool.tryTake(worker):
+                del self.workers[self.ticket]
+            else:
+                worker.cancel()
+        self.results.pop(self.ticket, None)
+        self.pipelines.pop(self.ticket, None)
+        self.showNext()
 
     def buttonOkClicked(self):
-        
-        self.male = self.maleEdit.text()
-
-        #name
-        self.name = self.nameEdit.text()
-        self.midName = self.midNameEdit.text()
-        self.lastName = self.lastnameEdit.text()
-
-        self.dateBirth = self.dateBirthEdit.text()
-        self.place = self.placeEdit.text()
-        self.code = self.codeEdit.text()
-
-        #data
-        self.serial = self.serEdit.text()
-        self.number = self.numEdit.text()
-
-        #
-        self.date_1 = self.dateEdit_1.text()
-        self.date_2 = self.dateEdit_2.text()
-
-       
-        self.data = {
-            "passport data": {            
-                "Имя": self.name,
-                "Фамилия": self.lastName,
-                "Отчество": self.midName,
-                "Пол": self.male,
-                "Серия": self.serial,
-                "Номер": self.number,  
-                "Дата получения": self.date_2,
-                "Дата рождения": self.dateBirth,
-                "Место рождения": self.place,
-                "Кем выдан": self.date_1,
-                "Код подразделения": self.code
-            }
-        }
-        with open("result2.json", "w", encoding='utf-8') as write_file:
-            json.dump(self.data, write_file, sort_keys=False, ensure_ascii=False, separators=(',', ': '))
-
-        #clear
+        """Appends the reviewed fields, normalized by `fields.validate`, to the result file.
+        The ones changed by the operator get the OPERATOR source. Nothing is saved until
+        the passport is recognized; a passport that can't be recognized is skipped with Cancel."""
+        if self.data is None:
+            self.statusbar.showMessage("Нет распознанных данных для сохранения")
+            return
+        data = PassportData()
+        for attr, edit in self.fieldEdits.items():
+            value = edit.text()
+            setattr(data, attr, value)
+            if (getattr(self.data, attr) or "") == value:
+                if attr in self.data.confidence:
+                    data.confidence[attr] = self.data.confidence[attr]
+                if attr in self.data.source:
+                    data.source[attr] = self.data.source[attr]
+            else:
+                data.source[attr] = PassportData.OPERATOR
+        data.invalid = fields.validate(data)
+        with io.open(self.resultFile, "a", encoding='utf-8') as fp:
+            export.JSONLinesWriter(fp, ("file",)).write(data, file=self.picture)
+
+        self.results.pop(self.ticket, None)
+        self.pipelines.pop(self.ticket, None)
+        self.showNext()
+
+    def clearEdits(self):
+        for edit in self.fieldEdits.values():
+            edit.setStyleSheet("")
         self.placeEdit.clear()
         self.maleEdit.clear()
         self.nameEdit.clear()
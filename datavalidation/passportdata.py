@@ -1,5 +1,33 @@
 
 class PassportData():
+   """Recognized passport fields, with the OCR confidence and the source of every field
+   and the fields that failed their checks.
+
+   A compact record (`__slots__`) with a fixed schema: `ATTRIBUTES` in the order of `FIELDS`.
+   See datavalidation.export for bulk JSON Lines, CSV and Parquet output."""
+
+   # Field names of the saved passport data (see tests/result/result1.json) -> attributes
+   FIELDS = [
+        ("Имя", 'name'),
+        ("Фамилия", 'lastName'),
+        ("Отчество", 'midName'),
+        ("Пол", 'male'),
+        ("Серия", 'serial'),
+        ("Номер", 'number'),
+        ("Дата получения", 'dataExtradition'),
+        ("Дата рождения", 'dateBirth'),
+        ("Место рождения", 'place'),
+        ("Кем выдан", 'placeExtradition'),
+        ("Код подразделения", 'code'),
+   ]
+
+   ATTRIBUTES = tuple(attr for field, attr in FIELDS)
+
+   # Source of the fields typed or corrected by the operator
+   OPERATOR = "operator"
+
+   __slots__ = ATTRIBUTES + ('confidence', 'source', 'invalid')
+
    def __init__(self):
 
         self.male = None           #пол
@@ -8,7 +36,7 @@ class PassportData():
         self.midName = None
         self.lastName = None
 
-        self.dateBirth = None 
+        self.dateBirth = None
         self.place = None          #место рождения
         self.code = None           #код подразделения
 
@@ -19,4 +47,47 @@ class PassportData():
         self.placeExtradition = None #место и дата получения
         self.dataExtradition = None
 
+        # attribute -> OCR confidence (0-100) of the text it was read from, None if unknown
+        self.confidence = {}
+        # attribute -> name of the block it was read from, "MRZ" or OPERATOR
+        self.source = {}
+        # attributes whose values failed the checks of datavalidation.fields
+        self.invalid = []
+
+   def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+   def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+   def __eq__(self, other):
+        return isinstance(other, PassportData) and self.__getstate__() == other.__getstate__()
+
+   # Compared by value, but changed in place: not hashable
+   __hash__ = None
+
+   def __repr__(self):
+        return "PassportData(%s)" % ", ".join("%s=%r" % (attr, getattr(self, attr)) for attr in self.ATTRIBUTES)
+
+   def uncertain(self, threshold):
+        """Attributes read with a confidence below the threshold, to be checked by the operator"""
+        return [attr for attr in self.ATTRIBUTES
+                if self.confidence.get(attr) is not None and self.confidence[attr] < threshold]
+
+   def to_row(self):
+        """The field values as a tuple, in the order of `ATTRIBUTES`"""
+        return tuple(getattr(self, attr) for attr in self.ATTRIBUTES)
+
+   def to_dict(self):
+        """Returns the data in the shape it is saved to json"""
+        return {"passport data": {field: getattr(self, attr) for field, attr in self.FIELDS}}
 
+   @classmethod
+   def from_dict(cls, data):
+        """Reads the data saved by `to_dict`"""
+        values = data["passport data"]
+        result = cls()
+        for field, attr in cls.FIELDS:
+            setattr(result, attr, values.get(field))
+        return result
@@ -1,8 +1,17 @@
+import os
+import itertools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
 import cv2
 import numpy as np
-from pasportrecogniotion.util.docdescription import DocDescription
+from pasportrecogniotion.util.docdescription import DocDescription, RecognitionCancelled, load_template
+from pasportrecogniotion.util.ocr import get_backend, set_backend
+from pasportrecogniotion.util.imagefile import load_image, to_array
+from pasportrecogniotion.util import mrz
 from pasportrecogniotion.util.pipeline import Pipeline
 from datavalidation.passportdata import PassportData
+from datavalidation import fields
 
 def show(img):
     cv2.imshow("test", img)
@@ -10,35 +19,152 @@ def show(img):
 
 
 class OpenCVPreProc(object):
-    """Preperocessing for OpenCV"""
+    """Preperocessing for OpenCV.
 
-    __depends__ = []
+    The kernel sizes are tuned for pages about `BASE_HEIGHT` pixels high. When `base_height` is given,
+    the kernels are scaled by the ratio of the `img_small` height to it."""
+
+    BASE_HEIGHT = 900
+
+    __depends__ = ['img_small']
     __provides__ = ['rectKernel','sqKernel']
 
-    def __init__(self):
-        self.rectKernel = cv2.getStructuringElement(cv2.MORPH_RECT, (13, 5))
-        self.sqKernel = cv2.getStructuringElement(cv2.MORPH_RECT, (17, 17))
+    def __init__(self, base_height=None):
+        self.base_height = base_height
 
-    def __call__(self):
-        return  self.rectKernel, self.sqKernel
+    def __call__(self, img_small):
+        k = 1.0 if self.base_height is None else img_small.shape[0] / self.base_height
+        size = lambda n: max(1, int(round(n * k)))
+        rectKernel = cv2.getStructuringElement(cv2.MORPH_RECT, (size(13), size(5)))
+        sqKernel = cv2.getStructuringElement(cv2.MORPH_RECT, (size(17), size(17)))
+        return rectKernel, sqKernel
 
 
 
 class GrayConverter(object):
-    """Convert img to GRAY"""
+    """Convert img to GRAY. A `LazyImage` is decoded straight to grayscale."""
 
-    __depends__ = ['rectKernel']
-    __provides__ = ['img', 'img_real']
+    __depends__ = []
+    __provides__ = ['img_real']
 
     def __init__(self, img):
         self.img = img
 
-    def __call__(self, rectKernel):
-        img = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(img, (3, 3), 0)
-        blackhat = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, rectKernel)
-
-        return blackhat, img
+    def __call__(self):
+        img = to_array(self.img)
+        if img.ndim == 2:
+            return img
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def _order_corners(quad):
+    """Sorts 4 points as top-left, top-right, bottom-right, bottom-left"""
+    quad = quad.reshape(4, 2).astype(np.float32)
+    s, d = quad.sum(axis=1), np.diff(quad, axis=1).ravel()
+    return np.array([quad[np.argmin(s)], quad[np.argmin(d)], quad[np.argmax(s)], quad[np.argmax(d)]])
+
+
+class PageLocalizer(object):
+    """Finds the document page in `img_page` and normalizes it to the template proportions.
+    Outputs `img_real` and `page_quad` - the page corners in `img_page` (None if the page isn't found).
+
+    The page quadrilateral is searched for on a copy downscaled to `detect_height`. A page that is
+    not found, or already fills the image, is passed through as is; an upright page is cropped
+    (a view, without copying), and only a rotated or skewed one is warped."""
+
+    __depends__ = ['img_page']
+    __provides__ = ['img_real', 'page_quad']
+
+    def __init__(self, width, height, detect_height=400, min_area=0.3, tolerance=0.02):
+        """
+        :param width, height: The template size: the warped page gets its proportions.
+        :param min_area: Minimal page area, as a fraction of the image area.
+        :param tolerance: Corner deviation, as a fraction of the image size, still considered aligned.
+        """
+        self.width = width
+        self.height = height
+        self.detect_height = detect_height
+        self.min_area = min_area
+        self.tolerance = tolerance
+
+    def find_page(self, img):
+        """The page corners (top-left, top-right, bottom-right, bottom-left) in `img` coordinates, or None"""
+        scale = min(1.0, self.detect_height / img.shape[0])
+        small = img if scale == 1.0 else cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        edges = cv2.Canny(cv2.GaussianBlur(small, (5, 5), 0), 50, 150)
+        edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, None, iterations=2)
+        cs, hierarchy = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        aspect = self.height / self.width
+        min_area = self.min_area * small.shape[0] * small.shape[1]
+        for c in sorted(cs, key=cv2.contourArea, reverse=True)[:5]:
+            if cv2.contourArea(c) < min_area:
+                break
+            quad = cv2.approxPolyDP(c, 0.02 * cv2.arcLength(c, True), True)
+            if len(quad) != 4 or not cv2.isContourConvex(quad):
+                continue
+            quad = _order_corners(quad) / scale
+            page_height = (np.linalg.norm(quad[3] - quad[0]) + np.linalg.norm(quad[2] - quad[1])) / 2
+            page_width = (np.linalg.norm(quad[1] - quad[0]) + np.linalg.norm(quad[2] - quad[3])) / 2
+            if abs(page_height / page_width / aspect - 1) < 0.25:
+                return quad
+        return None
+
+    def __call__(self, img_page):
+        quad = self.find_page(img_page)
+        if quad is None:
+            return img_page, None
+
+        h, w = img_page.shape[:2]
+        tolerance = self.tolerance * max(h, w)
+        corners = np.array([(0, 0), (w - 1, 0), (w - 1, h - 1), (0, h - 1)], dtype=np.float32)
+        if np.abs(quad - corners).max() <= tolerance:
+            return img_page, quad
+
+        x0, y0 = quad.min(axis=0)
+        x1, y1 = quad.max(axis=0)
+        box = np.array([(x0, y0), (x1, y0), (x1, y1), (x0, y1)], dtype=np.float32)
+        if np.abs(quad - box).max() <= tolerance:
+            x0, y0 = max(int(x0), 0), max(int(y0), 0)
+            return img_page[y0:int(np.ceil(y1)) + 1, x0:int(np.ceil(x1)) + 1], quad
+
+        page_height = int(round(max(np.linalg.norm(quad[3] - quad[0]), np.linalg.norm(quad[2] - quad[1]))))
+        page_width = int(round(page_height * self.width / self.height))
+        target = np.array([(0, 0), (page_width - 1, 0), (page_width - 1, page_height - 1), (0, page_height - 1)],
+                          dtype=np.float32)
+        M = cv2.getPerspectiveTransform(quad, target)
+        return cv2.warpPerspective(img_page, M, (page_width, page_height), flags=cv2.INTER_LINEAR,
+                                   borderMode=cv2.BORDER_REPLICATE), quad
+
+
+class WorkingResolution(object):
+    """Downscales `img_real` for the document localization stages.
+    Outputs `img_small` and the `scale` from `img_real` to `img_small` coordinates.
+    Without a `height`, or for smaller images, `img_small` is `img_real` itself."""
+
+    __depends__ = ['img_real']
+    __provides__ = ['img_small', 'scale']
+
+    def __init__(self, height=None):
+        self.height = height
+
+    def __call__(self, img_real):
+        if self.height is None or img_real.shape[0] <= self.height:
+            return img_real, 1.0
+        scale = self.height / img_real.shape[0]
+        img_small = cv2.resize(img_real, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return img_small, scale
+
+
+class BlackHat(object):
+    """Outputs `img` - the black top-hat of the blurred `img_small`"""
+
+    __depends__ = ['img_small', 'rectKernel']
+    __provides__ = ['img']
+
+    def __call__(self, img_small, rectKernel):
+        gray = cv2.GaussianBlur(img_small, (3, 3), 0)
+        return cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, rectKernel)
 
 class BooneTransform(object):
     """Processes `img_small` according to Hans Boone's method
@@ -69,92 +195,252 @@ class BooneTransform(object):
 
 
 class MRZBoxLocator(object):
-    """Extracts putative passport's data as DataBlock-s instances from the contours of `img_binary`"""
+    """Extracts putative passport's data as DataBlock-s instances from the contours of `img_binary`.
+    The contours are mapped back from `img_small` to `img_real` coordinates, where the OCR is done.
+    Outputs `boxes` - the DocDescription, whose blocks are recognized when they are requested."""
 
-    __depends__ = ['img_binary','img_real']
+    __depends__ = ['img_binary', 'img_real', 'scale']
     __provides__ = ['boxes']
 
-    def __init__(self, doc_description):
+    def __init__(self, doc_description, workers=None, progress=None, cancel=None, min_confidence=None,
+                 stitch=False):
         self.doc_description = doc_description
+        self.workers = workers
+        self.progress = progress
+        self.cancel = cancel
+        self.min_confidence = min_confidence
+        self.stitch = stitch
 
-    def __call__(self, img_binary, img_real):
+    def __call__(self, img_binary, img_real, scale):
         cs, hierarchy = cv2.findContours(img_binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        self.doc_description.extract_data(img_real, cs)
+        if scale != 1.0:
+            cs = [np.round(c / scale).astype(np.int32) for c in cs]
+        self.doc_description.assign(img_real, cs, self.workers, self.progress, self.cancel, self.min_confidence,
+                                    self.stitch)
 
-        return self.doc_description.blocks
+        return self.doc_description
 
 
 class BoxToData(object):
+    """Builds PassportData from the blocks, requesting only the blocks it needs.
+
+    With `mrz_first`, the MRZ is parsed first and the fields confirmed by its check digits
+    are taken from it, so their printed blocks are never recognized. Every other field is read
+    from the first of its `fields.SPECS` blocks; the next ones are recognized only when the value
+    read so far fails the field check. The fields still failing it are listed in `PassportData.invalid`."""
 
     __depends__ = ['boxes']
     __provides__ = ['data']
 
+    def __init__(self, mrz_first=True):
+        self.mrz_first = mrz_first
+
     def __call__(self, boxes):
 
         data = PassportData()
-
-        data.name = "".join(boxes["Имя"].data).replace("\n"," ").replace(".","")
-        data.lastName = "".join(boxes["Фамилия"].data).replace("\n"," ").replace(".","")
-        data.midName = "".join(boxes["Отчество"].data).replace("\n"," ").replace(".","")
-
-        data.serial = "".join(boxes["Серия1"].data)
-        if (len(data.serial)!=4):
-            data.serial = "".join(boxes["Серия2"].data)
-
-        data.number = "".join(boxes["Номер1"].data)
-        if (len(data.serial) != 6):
-            data.serial = "".join(boxes["Серия2"].data)
-
-
-        dateBirth = "".join(filter(lambda x: len(x.replace(".",""))>2,boxes["Дата рождения"].data))
-        if len(dateBirth)>=9:
-            data.dateBirth = dateBirth[0:10]
-
-        data.male = "".join(boxes["Пол"].data)
-
-        data.place = "".join(filter(lambda x: len(x.replace(".",""))>2,boxes["Место рождения"].data)).replace("\n", " ")
-
-        data.placeExtradition = "".join(filter(
-            lambda x : len(x.replace(" ","").replace(".","").replace("-",""))>3,
-                                               boxes["Паспорт выдан"].data)).replace("\n", " ")
-
-        data.dataExtradition = "".join(filter(lambda x: len(x.replace(".",""))>2,
-                                              boxes["Дата выдачи"].data))
-
-
-        data.code="".join(boxes["Код подразделения"].data).replace("\n", "")
-
+        specs = list(fields.SPECS.values())
+        invalid = set()
+
+        if self.mrz_first and "MRZ" in boxes.blocks:
+            # The fields missing from the MRZ are needed anyway: recognize them along with it
+            boxes.recognize(["MRZ"] + [spec.blocks[0] for spec in specs if spec.attr not in mrz.ATTRIBUTES])
+            parsed = mrz.parse_mrz("\n".join(boxes["MRZ"].mrz))
+            if parsed is not None:
+                for attr in parsed.checked:
+                    value, valid = fields.SPECS[attr].normalize(parsed.fields[attr])
+                    setattr(data, attr, value)
+                    # Confirmed by the check digits; the sex and the names are only as sure as the MRZ OCR
+                    if attr in mrz.CHECK_DIGIT_ATTRIBUTES:
+                        data.confidence[attr] = 100.0
+                    else:
+                        data.confidence[attr] = boxes["MRZ"].confidence
+                    data.source[attr] = "MRZ"
+                    if not valid:
+                        invalid.add(attr)
+                specs = [spec for spec in specs if spec.attr not in parsed.checked]
+
+        # The primary blocks of the remaining fields are needed anyway: request them together,
+        # so that they are recognized concurrently when the document has several workers
+        boxes.recognize([spec.blocks[0] for spec in specs])
+
+        for spec in specs:
+            for name in spec.blocks:
+                value, valid = spec.parse(boxes[name].data)
+                if valid:
+                    break
+            setattr(data, spec.attr, value)
+            data.confidence[spec.attr] = boxes[name].confidence
+            data.source[spec.attr] = name
+            if not valid:
+                invalid.add(spec.attr)
+
+        data.invalid = [attr for attr in PassportData.ATTRIBUTES if attr in invalid]
         return data
 
 
-
 class MRZPipeline(Pipeline):
     """This is the  pipeline for parsing passport' data from a given image file."""
 
-    def __init__(self, img, docfile, extra_cmdline_params=''):
-        super(MRZPipeline, self).__init__()
-        self.version = '1.0'
-        self.add_component('opencv', OpenCVPreProc())
-        self.add_component('loader', GrayConverter(img))
+    # Change whenever the pipeline gives different results for the same input, to invalidate ResultCache-s
+    version = '1.4'
+
+    def __init__(self, img, docfile, extra_cmdline_params='', workers=None, work_scale=None,
+                 progress=None, cancel=None, localize=True, min_confidence=None, stitch=False, executor=None):
+        """
+        :param work_scale: If given, the document is localized on a copy of the image downscaled to
+                           `work_scale` pixels per unit of the document description height, with
+                           kernels scaled accordingly. The OCR still uses the full resolution image.
+        :param progress, cancel: Per-block progress callback and cancellation event, see
+                                 `DocDescription.extract_data`.
+        :param localize: Find the page in the image and warp it to the template proportions
+                         (see `PageLocalizer`). Otherwise the whole image is taken as the page.
+        :param min_confidence: Re-read the blocks recognized with a lower confidence (0-100)
+                               with more expensive OCR settings, see `DataBlock.recognize`.
+        :param stitch: Read the blocks needed at once with one OCR call per language, on an image
+                       stacking them (see `read_stitched`), instead of one call per block.
+        :param executor: Runs the components that don't depend on each other concurrently, see `Pipeline`.
+        """
+        super(MRZPipeline, self).__init__(executor)
+        doc_description = DocDescription(docfile)
+        if work_scale is None:
+            self.add_component('resizer', WorkingResolution())
+            self.add_component('opencv', OpenCVPreProc())
+        else:
+            self.add_component('resizer', WorkingResolution(int(work_scale * doc_description.height)))
+            self.add_component('opencv', OpenCVPreProc(OpenCVPreProc.BASE_HEIGHT))
+        if localize:
+            self.add_component('loader', GrayConverter(img), ['img_page'])
+            self.add_component('localizer', PageLocalizer(doc_description.width, doc_description.height))
+        else:
+            self.add_component('loader', GrayConverter(img))
+        self.add_component('blackhat', BlackHat())
         self.add_component('boone', BooneTransform())
-        self.add_component('box_locator', MRZBoxLocator(DocDescription(docfile)))
+        self.add_component('box_locator', MRZBoxLocator(doc_description, workers, progress, cancel,
+                                                        min_confidence, stitch))
         self.add_component('box_to_mrz', BoxToData())
 
     @property
     def result(self):
         return self['data']
 
-def recognise_doc(img, doc_descr):
+    def set_image(self, img):
+        """Recognizes another image with the same settings, reusing what doesn't depend on the image"""
+        self.update_params('loader', img=img)
+        return self.result
+
+    def update_block(self, name, **changes):
+        """Re-runs one block after its settings are corrected (see `DocDescription.update_block`):
+        the page is not processed again and the other blocks keep their text.
+        Returns the updated PassportData."""
+        self['boxes'].update_block(name, **changes)
+        self.touch('boxes')
+        return self.result
+
+    def retry_invalid(self):
+        """Reads the blocks of the fields that failed their checks (`PassportData.invalid`) again with
+        all the more expensive OCR settings, see `DocDescription.retry`. The other blocks keep their text.
+        Returns the updated PassportData."""
+        boxes = self['boxes']
+        names = [name for attr in self.result.invalid for name in fields.SPECS[attr].blocks if name in boxes.blocks]
+        if names:
+            boxes.retry(names)
+            self.touch('boxes')
+        return self.result
+
+def recognise_doc(img, doc_descr, workers=None, work_scale=None, cache=None, progress=None, cancel=None,
+                  min_confidence=None, stitch=False, executor=None):
     """The main interface function to this module, encapsulating the recognition pipeline.
        Given an image filename, runs MRZPipeline on it, returning the parsed MRZ object.
 
-    :param img: A img  to read the file data from.
+    :param img: A img  to read the file data from: a loaded image, an image file name, an encoded image
+                (bytes, memoryview, mmap) or a `LazyImage`. Files and encoded images are decoded straight to
+                grayscale, and not at all if the result is found in the `cache`.
     :param doc_descr: A file to read document description from.
+    :param workers: Number of threads recognizing the document blocks concurrently (sequential by default).
+    :param work_scale: Localize the document at a reduced resolution, see `MRZPipeline`.
+                       1.5 suits the bundled RusPass.json; full resolution by default.
+    :param cache: A `ResultCache`. A document already recognized with the same image content, description,
+                  pipeline version, OCR backend and options is returned from it without recognition.
+    :param progress: Called with every `DataBlock` as soon as it is recognized.
+    :param cancel: A `threading.Event` to stop the recognition, which then raises `RecognitionCancelled`.
+    :param min_confidence: Re-read only the blocks recognized with a lower confidence (0-100) with more
+                           expensive OCR settings. The confidences are in `PassportData.confidence`.
+    :param stitch: Read the blocks with one OCR call per language instead of one per block. Saves most
+                   of the tesseract launches of the pytesseract backend.
+    :param executor: A ThreadPoolExecutor to run the independent pipeline stages in, see `Pipeline`.
     """
-    p = MRZPipeline(img, doc_descr)
+    img = load_image(img)
+    if cache is not None:
+        key = cache.key(img, load_template(doc_descr), MRZPipeline.version, backend=get_backend().key,
+                        work_scale=work_scale, min_confidence=min_confidence, stitch=stitch)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    p = MRZPipeline(img, doc_descr, workers=workers, work_scale=work_scale, progress=progress, cancel=cancel,
+                    min_confidence=min_confidence, stitch=stitch, executor=executor)
     result = p.result
 
+    if cache is not None:
+        cache.put(key, result)
 
     return result
 
 
+BatchResult = namedtuple('BatchResult', ['index', 'source', 'data', 'error'])
+
+# State of a recognise_batch worker process, kept warm between documents
+_batch_description = None
+_batch_options = {}
+
+
+def _init_batch_worker(doc_descr, ocr_factory, options):
+    global _batch_description, _batch_options
+    _batch_description = load_template(doc_descr)
+    _batch_options = options
+    # Never share OCR engine handles inherited from the parent process: create a backend
+    # with the settings of the parent's one, see `OCRBackend.factory`
+    set_backend(ocr_factory())
+
+
+def _recognise_batch_item(source):
+    return recognise_doc(load_image(source), _batch_description, **_batch_options)
+
+
+def recognise_batch(paths_or_images, doc_descr, workers=None, max_pending=None, **options):
+    """Recognizes many documents in a pool of worker processes.
+
+    Every worker reads the document description and creates its OCR engine once, and reuses them
+    for all the documents it gets. Results are yielded as they complete (not in input order) as
+    `BatchResult(index, source, data, error)` tuples, where `index` is the position of the document
+    in `paths_or_images`. A failed document yields its exception in `error` and does not stop the batch.
+
+    :param paths_or_images: An iterable of image filenames, encoded image files (bytes) or already loaded images.
+    :param doc_descr: A file to read document description from.
+    :param workers: Number of worker processes, all the cores by default.
+    :param max_pending: Maximum number of documents submitted to the pool at once, so that long
+                        iterables are consumed lazily. Twice the number of workers by default.
+    :param options: Keyword arguments passed to `recognise_doc` for every document.
+    """
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or 2 * workers
+    sources = enumerate(paths_or_images)
+    pending = {}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                             initargs=(doc_descr, get_backend().factory(), options)) as executor:
+
+        def submit(count):
+            for index, source in itertools.islice(sources, count):
+                pending[executor.submit(_recognise_batch_item, source)] = (index, source)
+
+        submit(max_pending)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            finished = [(future, pending.pop(future)) for future in done]
+            submit(len(finished))
+            for future, (index, source) in finished:
+                try:
+                    yield BatchResult(index, source, future.result(), None)
+                except Exception as e:
+                    yield BatchResult(index, source, None, e)
@@ -0,0 +1,129 @@
+'''
+Recognition of multi-page scans (multi-page TIFF and PDF files).
+
+The scanners put the passport spread and other pages (e.g. the registration pages) into one file.
+The pages are read lazily, and a cheap layout check on a reduced copy of every page tells which of them
+match the document template; only those go through the recognition:
+
+    for result in recognise_pages("scan.tiff", "tests/data/RusPass.json"):
+        if result.data is not None:
+            print(result.page.name, result.data)
+
+    python -m pasportrecogniotion.stream scans/*.pdf --doc tests/data/RusPass.json --pages
+
+License: MIT
+'''
+
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from pasportrecogniotion.image import recognise_doc, PageLocalizer, OpenCVPreProc
+from pasportrecogniotion.util.docdescription import load_template
+from pasportrecogniotion.util.imagefile import iter_pages, LazyImage
+
+# A page of a scan: its index in the file, the page (a `LazyImage`), the layout score, and the recognized
+# PassportData or the error. Pages not matching the template have neither.
+PageResult = namedtuple('PageResult', ['index', 'page', 'score', 'data', 'error'])
+
+
+class LayoutClassifier(object):
+    """Tells whether a page has the layout of a document template.
+
+    The page is decoded at a reduced size, localized (see `PageLocalizer`) and brought to the template size.
+    The text is found there with a black top-hat, as for the recognition. The score is the share of the template
+    blocks that have text in them. Pages of the same size with other layouts (e.g. the registration pages of
+    the passport) leave most of the blocks empty."""
+
+    def __init__(self, doc_descr, min_score=0.6, min_ink=0.03, reduce=4, ink_threshold=40):
+        """
+        :param min_score: The share of the blocks with text in them for the page to match.
+        :param min_ink: The share of a block area covered by text for the block to have text.
+        :param reduce: The page is decoded downscaled by this factor (1, 2, 4 or 8), or less if it gets smaller
+                       than the template.
+        :param ink_threshold: The least black top-hat response taken for text.
+        """
+        self.template = load_template(doc_descr)
+        self.min_score = min_score
+        self.min_ink = min_ink
+        self.reduce = reduce
+        self.ink_threshold = ink_threshold
+        self.localizer = PageLocalizer(self.template.width, self.template.height)
+        self.bounds = self.template.bounds.astype(np.intp)
+
+    def preview(self, page):
+        """The page localized and resized to the template size"""
+        height = self.template.height
+        if isinstance(page, LazyImage):
+            # Decoded once more, less reduced, if the page is too small for the factor
+            factor = self.reduce
+            img = page.reduced(factor)
+            while img.shape[0] < height and factor > 1:
+                factor //= 2
+                img = page.reduced(factor)
+        else:
+            img = page
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if img.shape[0] > height:
+            # Some formats (TIFF, PNG) are decoded at full size: localize on a copy about the template size
+            img = cv2.resize(img, None, fx=height / img.shape[0], fy=height / img.shape[0],
+                             interpolation=cv2.INTER_AREA)
+        img = self.localizer(img)[0]
+        return cv2.resize(img, (self.template.width, height), interpolation=cv2.INTER_AREA)
+
+    def score(self, page):
+        """The share of the template blocks with text in them, 0 to 1"""
+        img = self.preview(page)
+        rectKernel = OpenCVPreProc(OpenCVPreProc.BASE_HEIGHT)(img)[0]
+        blackhat = cv2.morphologyEx(cv2.GaussianBlur(img, (3, 3), 0), cv2.MORPH_BLACKHAT, rectKernel)
+        ink = blackhat >= self.ink_threshold
+        filled = [ink[y0:y1, x0:x1].mean() >= self.min_ink
+                  for x0, y0, x1, y1 in self.bounds if x1 > x0 and y1 > y0]
+        return sum(filled) / len(filled) if filled else 0.0
+
+    def __call__(self, page):
+        return self.score(page) >= self.min_score
+
+
+def recognise_pages(source, doc_descr, classifier=None, dpi=200, **options):
+    """Recognizes the pages of a scan matching the document template, yielding a `PageResult` for every page
+    in order, as soon as it is classified or recognized. Nothing is decoded ahead of the page being processed.
+
+    :param source: A multi-page TIFF or PDF file name, an encoded file or an image, see `iter_pages`.
+    :param doc_descr: A file to read document description from.
+    :param classifier: A `LayoutClassifier`, by default one for `doc_descr`.
+    :param dpi: The resolution PDF pages are rendered at.
+    :param options: Keyword arguments passed to `recognise_doc` for every matching page.
+    """
+    classifier = classifier or LayoutClassifier(doc_descr)
+    for index, page in enumerate(iter_pages(source, dpi)):
+        try:
+            score = classifier.score(page)
+        except Exception as e:
+            yield PageResult(index, page, None, None, e)
+            continue
+        if score < classifier.min_score:
+            yield PageResult(index, page, score, None, None)
+            continue
+        try:
+            yield PageResult(index, page, score, recognise_doc(page, doc_descr, **options), None)
+        except Exception as e:
+            yield PageResult(index, page, score, None, e)
+
+
+def matching_pages(sources, classifier, dpi=200):
+    """Lazily expands the sources into their pages matching the template, e.g. for `recognise_stream`.
+    The sources and the pages that can't be read are passed through, for the recognition to report them."""
+    for source in sources:
+        try:
+            for page in iter_pages(source, dpi):
+                try:
+                    matched = classifier(page)
+                except IOError:
+                    matched = True
+                if matched:
+                    yield page
+        except IOError:
+            yield source
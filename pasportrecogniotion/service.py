@@ -0,0 +1,312 @@
+'''
+Asyncio front-end for the recognition: `recognise_doc_async` and a small HTTP service.
+
+The service recognizes documents in a pool of worker processes, each keeping its parsed template
+and OCR engine warm. Requests waiting for a free worker are grouped into batches sent to a worker
+at once, and concurrent requests with identical image content share one recognition.
+
+    python -m pasportrecogniotion.service --doc tests/data/RusPass.json --port 8080
+    curl --data-binary @tests/data/pas1.jpg http://127.0.0.1:8080/recognize
+    curl http://127.0.0.1:8080/metrics
+
+Endpoints: POST /recognize (the image file as the request body, or a multipart/form-data upload),
+GET /metrics and GET /health. Uses only the standard library.
+
+License: MIT
+'''
+
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email.parser import BytesParser
+
+import numpy as np
+
+from pasportrecogniotion.image import recognise_doc, _init_batch_worker, _recognise_batch_item
+from pasportrecogniotion.util.cache import image_digest
+from pasportrecogniotion.util.ocr import BACKENDS, get_backend, set_backend
+
+
+async def recognise_doc_async(img, doc_descr, executor=None, **options):
+    """Runs `recognise_doc` in an executor (the loop's default thread pool if None)
+    without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(recognise_doc, img, doc_descr, **options))
+
+
+def _recognise_many(sources):
+    # Runs in a worker process set up by _init_batch_worker
+    results = []
+    for source in sources:
+        try:
+            results.append((_recognise_batch_item(source), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+class ServiceMetrics(object):
+    """Counters and recent latencies of a `RecognitionService`."""
+
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.errors = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.batched_documents = 0
+        self.inflight = 0
+        self.latencies = deque(maxlen=window)
+
+    def as_dict(self, queue_depth=0):
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+        return dict(requests=self.requests, errors=self.errors, coalesced=self.coalesced,
+                    queue_depth=queue_depth, inflight=self.inflight, batches=self.batches,
+                    mean_batch_size=self.batched_documents / self.batches if self.batches else None,
+                    latency=dict(mean=sum(latencies) / len(latencies) if latencies else None,
+                                 p50=percentile(0.5), p95=percentile(0.95), p99=percentile(0.99)))
+
+
+class RecognitionService(object):
+    """Recognizes documents submitted from coroutines in a pool of worker processes.
+
+    :param doc_descr: A file to read document description from.
+    :param processes: Number of worker processes, all the cores by default.
+    :param max_batch: Maximum number of queued documents sent to a worker in one task.
+    :param batch_delay: Seconds to wait for more documents before sending a batch that isn't full.
+    :param options: Keyword arguments passed to `recognise_doc` for every document.
+    """
+
+    def __init__(self, doc_descr, processes=None, max_batch=8, batch_delay=0.005, **options):
+        self.doc_descr = doc_descr
+        self.processes = processes or os.cpu_count()
+        self.max_batch = max_batch
+        self.batch_delay = batch_delay
+        self.options = options
+        self.metrics = ServiceMetrics()
+        self.executor = None
+        self._queue = None
+        self._slots = None
+        self._batcher = None
+        self._coalesced = {}  # Image digest -> future of the recognition in progress
+
+    async def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.processes, initializer=_init_batch_worker,
+                                            initargs=(self.doc_descr, get_backend().factory(), self.options))
+        # Start all the workers before any connection is accepted: a worker forked while a request is
+        # served would inherit the client socket and keep the connection open after the reply
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid) for _ in range(self.processes)])
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.processes)
+        self._batcher = asyncio.ensure_future(self._run_batches())
+        return self
+
+    async def close(self):
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def recognise(self, img):
+        """Recognizes an encoded image file (bytes) or a loaded image, returning its `PassportData`."""
+        loop = asyncio.get_running_loop()
+        if isinstance(img, np.ndarray):
+            key = image_digest(img)
+        else:
+            img = bytes(img)
+            key = hashlib.sha1(img).hexdigest()
+
+        self.metrics.requests += 1
+        future = self._coalesced.get(key)
+        if future is None:
+            future = loop.create_future()
+            self._coalesced[key] = future
+            future.add_done_callback(lambda _: self._coalesced.pop(key, None))
+            self._queue.put_nowait((img, future, time.perf_counter()))
+        else:
+            self.metrics.coalesced += 1
+        return await asyncio.shield(future)
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # While every worker is busy, requests pile up in the queue and later go as one batch
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.max_batch:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        self.metrics.batches += 1
+        self.metrics.batched_documents += len(batch)
+        self.metrics.inflight += len(batch)
+        try:
+            results = await loop.run_in_executor(self.executor, _recognise_many, [img for img, _, _ in batch])
+        except Exception as e:
+            results = [(None, e)] * len(batch)
+        finally:
+            self.metrics.inflight -= len(batch)
+            self._slots.release()
+
+        now = time.perf_counter()
+        for (_, future, started), (data, error) in zip(batch, results):
+            self.metrics.latencies.append(now - started)
+            if error is not None:
+                self.metrics.errors += 1
+                future.set_exception(error)
+            else:
+                future.set_result(data)
+
+    def metrics_dict(self):
+        return self.metrics.as_dict(self.queue_depth)
+
+
+class HTTPService(object):
+    """A minimal HTTP/1.0 server over a `RecognitionService`. One request per connection."""
+
+    def __init__(self, service, max_body=32 * 2 ** 20):
+        self.service = service
+        self.max_body = max_body
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def _upload(headers, body):
+        content_type = headers.get('content-type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return body
+        message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+        for part in message.walk():
+            if not part.is_multipart():
+                return part.get_payload(decode=True)
+        raise ValueError("No file in the upload")
+
+    async def _route(self, method, path, headers, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.service.metrics_dict()
+        if method == 'POST' and path == '/recognize':
+            try:
+                upload = self._upload(headers, body)
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            try:
+                data = await self.service.recognise(upload)
+            except IOError as e:
+                return 400, {'error': str(e)}
+            except Exception as e:
+                return 500, {'error': "%s: %s" % (type(e).__name__, e)}
+            return 200, data.to_dict()
+        return 404, {'error': "Not found"}
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+            except (ValueError, UnicodeDecodeError):
+                status, payload = 400, {'error': "Bad request"}
+            else:
+                if length > self.max_body:
+                    status, payload = 413, {'error': "Request body too large"}
+                else:
+                    body = await reader.readexactly(length)
+                    status, payload = await self._route(method, path.split('?')[0], headers, body)
+
+            content = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            writer.write(('HTTP/1.0 %d %s\r\nContent-Type: application/json; charset=utf-8\r\n'
+                          'Content-Length: %d\r\nConnection: close\r\n\r\n'
+                          % (status, _REASONS.get(status, ''), len(content))).encode('latin-1') + content)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+async def serve(doc_descr, host='127.0.0.1', port=8080, processes=None, max_batch=8, **options):
+    """Runs the HTTP service until cancelled."""
+    async with RecognitionService(doc_descr, processes, max_batch, **options) as service:
+        http = HTTPService(service)
+        await http.start(host, port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await http.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP service recognizing passports")
+    parser.add_argument('--doc', required=True, help="document description, e.g. tests/data/RusPass.json")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--processes', type=int, default=None, help="worker processes, all cores by default")
+    parser.add_argument('--max-batch', type=int, default=8, help="maximum documents per worker task")
+    parser.add_argument('--ocr', default=None, choices=sorted(BACKENDS), help="OCR backend")
+    parser.add_argument('--work-scale', type=float, default=None, help="reduced localization resolution")
+    parser.add_argument('--min-confidence', type=float, default=None,
+                        help="re-read the blocks recognized with a lower OCR confidence (0-100)")
+    parser.add_argument('--stitch', action='store_true', help="one OCR call per language for the blocks of a page")
+    args = parser.parse_args(argv)
+
+    if args.ocr is not None:
+        set_backend(args.ocr)
+    try:
+        asyncio.run(serve(args.doc, args.host, args.port, args.processes, args.max_batch,
+                          work_scale=args.work_scale, min_confidence=args.min_confidence,
+                          stitch=args.stitch))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+'''
+Streaming recognition of many images with bounded memory.
+
+Images are read from directories, glob patterns, a list of paths on stdin or a local queue,
+decoded to grayscale in a prefetch thread and recognized by a pool of threads, with at most `max_inflight`
+documents decoded at any time. Results come out incrementally, in input order.
+
+    python -m pasportrecogniotion.stream scans/ 'more/*.jpg' --doc tests/data/RusPass.json -o out.jsonl
+    find scans -name '*.jpg' | python -m pasportrecogniotion.stream - --doc tests/data/RusPass.json
+    python -m pasportrecogniotion.stream scans/ --doc tests/data/RusPass.json -o out.parquet
+    python -m pasportrecogniotion.stream 'scans/*.tiff' --doc tests/data/RusPass.json --pages
+
+License: MIT
+'''
+
+import argparse
+import glob
+import os
+import queue
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from datavalidation import export
+from pasportrecogniotion.image import recognise_doc, recognise_batch, BatchResult
+from pasportrecogniotion.util.ocr import BACKENDS, set_backend
+from pasportrecogniotion.util.imagefile import load_image, to_array, LazyImage
+from pasportrecogniotion.pages import LayoutClassifier, matching_pages
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+_DONE = object()
+
+
+def iter_sources(*sources):
+    """Lazily expands the sources into image paths.
+
+    A source is a directory (its image files), a glob pattern, '-' (paths read from stdin, one per line),
+    a `queue.Queue` (items are taken until a None is put) or anything else, passed through as is
+    (a path or an already loaded image).
+    """
+    for source in sources:
+        if isinstance(source, queue.Queue):
+            for item in iter(source.get, None):
+                yield item
+        elif not isinstance(source, str):
+            yield source
+        elif source == '-':
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    yield line
+        elif os.path.isdir(source):
+            for entry in os.scandir(source):
+                if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield entry.path
+        elif any(c in source for c in '*?['):
+            for path in glob.iglob(source, recursive=True):
+                yield path
+        else:
+            yield source
+
+
+def _acquire(slots, stop):
+    """Waits for a free slot, giving up when the stream is stopped"""
+    while not stop.is_set():
+        if slots.acquire(timeout=0.1):
+            return True
+    return False
+
+
+def _prefetch(sources, decoded, slots, stop):
+    try:
+        # Every source takes a slot, before it is even read, until its result is taken from the stream
+        while _acquire(slots, stop):
+            source = next(sources, _DONE)
+            if source is _DONE:
+                break
+            img, error = source, None
+            try:
+                # Decoded here, ahead of the recognition, to keep the workers busy
+                img = load_image(source)
+                to_array(img)
+            except IOError as e:
+                error = e
+            decoded.put((source, img, error))
+    except Exception as e:
+        decoded.put((None, None, e))
+    finally:
+        decoded.put(_DONE)
+
+
+def _result(index, source, future, error):
+    if error is not None:
+        return BatchResult(index, source, None, error)
+    try:
+        return BatchResult(index, source, future.result(), None)
+    except Exception as e:
+        return BatchResult(index, source, None, e)
+
+
+def recognise_stream(sources, doc_descr, workers=1, max_inflight=None, **options):
+    """Recognizes a stream of images, yielding a `BatchResult` for each one in input order.
+
+    The sources are consumed lazily, so this works for unbounded streams, and no more than
+    `max_inflight` decoded images are kept in memory: an image is decoded only when one of the
+    previous ones has been recognized and its result taken.
+
+    Closing the generator early doesn't wait for the next source. A prefetch thread waiting for it
+    (e.g. for a line of stdin or an item of a queue) exits when it comes.
+
+    :param sources: An iterable of image paths or loaded images, see `iter_sources`.
+    :param doc_descr: A file to read document description from.
+    :param workers: Number of threads recognizing documents concurrently.
+    :param max_inflight: Maximum number of decoded documents, twice the number of workers by default.
+    :param options: Keyword arguments passed to `recognise_doc` for every document.
+    """
+    max_inflight = max_inflight or 2 * workers
+    decoded = queue.Queue()  # Bounded by the slots
+    slots = threading.Semaphore(max_inflight)
+    stop = threading.Event()
+    prefetch = threading.Thread(target=_prefetch, args=(iter(sources), decoded, slots, stop), daemon=True)
+    prefetch.start()
+
+    inflight = deque()
+    index = 0
+
+    def take():
+        result = _result(*inflight.popleft())
+        slots.release()
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                # Results are given as soon as they are ready, not only when the next source comes
+                while inflight and (inflight[0][2] is None or inflight[0][2].done()):
+                    yield take()
+                try:
+                    item = decoded.get(timeout=0.05 if inflight else None)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    break
+                source, img, error = item
+                future = None
+                if error is None:
+                    future = executor.submit(recognise_doc, img, doc_descr, **options)
+                inflight.append((index, source, future, error))
+                index += 1
+                if len(inflight) >= max_inflight:
+                    yield take()
+            while inflight:
+                yield take()
+        finally:
+            # The prefetch thread stops at its next slot; it may be blocked in the source, so don't wait for it
+            stop.set()
+            for _, _, future, _ in inflight:
+                if future is not None:
+                    future.cancel()
+
+
+def _file(result):
+    if isinstance(result.source, LazyImage):
+        return result.source.name
+    return result.source if isinstance(result.source, str) else result.index
+
+
+def _error(result):
+    return "%s: %s" % (type(result.error).__name__, result.error)
+
+
+def write_results(results, writer):
+    """Writes the results to a `datavalidation.export` writer with the "file" and "error" extra columns
+    as they come, returning the number of failed documents."""
+    failed = 0
+    for result in results:
+        if result.error is not None:
+            failed += 1
+            writer.write(None, file=_file(result), error=_error(result))
+        else:
+            writer.write(result.data, file=_file(result))
+    return failed
+
+
+def write_jsonl(results, fp):
+    """Writes the results as JSON Lines as they come, returning the number of failed documents."""
+    return write_results(results, export.JSONLinesWriter(fp, ("file",), flush=True))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recognize passports from a stream of images into JSON Lines, CSV or Parquet")
+    parser.add_argument('sources', nargs='+', help="image files, directories, glob patterns or - for stdin")
+    parser.add_argument('--doc', required=True, help="document description, e.g. tests/data/RusPass.json")
+    parser.add_argument('-o', '--output', default='-', help="output file, stdout by default")
+    parser.add_argument('--format', default=None, choices=['jsonl', 'csv', 'parquet'],
+                        help="output format, by the extension of the output file by default (JSON Lines on stdout)")
+    parser.add_argument('--workers', type=int, default=1, help="recognition threads")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="use a pool of processes instead of threads (results are then unordered)")
+    parser.add_argument('--max-inflight', type=int, default=None, help="maximum documents in memory")
+    parser.add_argument('--ocr', default=None, choices=sorted(BACKENDS), help="OCR backend")
+    parser.add_argument('--work-scale', type=float, default=None, help="reduced localization resolution")
+    parser.add_argument('--min-confidence', type=float, default=None,
+                        help="re-read the blocks recognized with a lower OCR confidence (0-100)")
+    parser.add_argument('--stitch', action='store_true', help="one OCR call per language for the blocks of a page")
+    parser.add_argument('--pages', action='store_true',
+                        help="recognize the pages of multi-page TIFF and PDF files matching the document layout")
+    parser.add_argument('--dpi', type=int, default=200, help="resolution of the PDF pages")
+    args = parser.parse_args(argv)
+
+    if args.ocr is not None:
+        set_backend(args.ocr)
+    paths = iter_sources(*args.sources)
+    if args.pages:
+        paths = matching_pages(paths, LayoutClassifier(args.doc), args.dpi)
+    if args.processes:
+        results = recognise_batch(paths, args.doc, workers=args.processes, max_pending=args.max_inflight,
+                                  work_scale=args.work_scale, min_confidence=args.min_confidence,
+                                  stitch=args.stitch)
+    else:
+        results = recognise_stream(paths, args.doc, workers=args.workers, max_inflight=args.max_inflight,
+                                   work_scale=args.work_scale, min_confidence=args.min_confidence,
+                                  stitch=args.stitch)
+
+    if args.output == '-':
+        failed = write_jsonl(results, sys.stdout)
+    else:
+        with export.open_writer(args.output, args.format, ("file", "error")) as writer:
+            failed = write_results(results, writer)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+'''
+PassportEye::Util: Caches of recognition results.
+
+`ResultCache` stores recognized documents keyed by the image content (the pixels, or the encoded file
+of a `LazyImage`), the document template and the pipeline version, in memory (LRU) and optionally
+in a sqlite file.
+`BlockCache` stores OCR results keyed by the content of the block image, so that pages which
+differ only in some blocks reuse the OCR of the others.
+
+License: MIT
+'''
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from pasportrecogniotion.util.imagefile import LazyImage
+
+
+def image_digest(img):
+    """A hash of the image pixels, shape and type. A `LazyImage` is hashed by its encoded file, without decoding it."""
+    if isinstance(img, LazyImage):
+        return img.digest
+    img = np.ascontiguousarray(img)
+    h = hashlib.sha1()
+    h.update(("%s%s" % (img.shape, img.dtype)).encode())
+    h.update(img.data)
+    return h.hexdigest()
+
+
+class LRUCache(object):
+    """Thread-safe in-memory mapping keeping at most `maxsize` most recently used items."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize, '_items': self._items}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class DiskCache(object):
+    """Bytes stored in a sqlite file, evicting the least recently used entries
+    when the total size exceeds `max_bytes`. Safe to share between threads and processes."""
+
+    def __init__(self, path, max_bytes=512 * 2 ** 20):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS cache "
+                       "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS cache_atime ON cache (atime)")
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, and aren't inherited by worker processes
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+        return db
+
+    def get(self, key, default=None):
+        with self._connection() as db:
+            row = db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            db.execute("UPDATE cache SET atime = ? WHERE key = ?", (time.time(), key))
+        return bytes(row[0])
+
+    def put(self, key, value):
+        with self._connection() as db:
+            db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            while total > self.max_bytes:
+                row = db.execute("SELECT key, size FROM cache ORDER BY atime LIMIT 1").fetchone()
+                if row is None:
+                    break
+                db.execute("DELETE FROM cache WHERE key = ?", (row[0],))
+                total -= row[1]
+
+    def clear(self):
+        with self._connection() as db:
+            db.execute("DELETE FROM cache")
+
+    def __getstate__(self):
+        return {'path': self.path, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+
+class ResultCache(object):
+    """Recognition results (any picklable objects) in an in-memory LRU tier and an optional disk tier.
+
+    Values are stored pickled, so every `get` returns a fresh copy that the caller may modify.
+
+    :param maxsize: Number of results kept in memory.
+    :param path: A sqlite file for the disk tier, None to keep the results in memory only.
+    :param max_bytes: Size limit of the disk tier.
+    """
+
+    def __init__(self, maxsize=256, path=None, max_bytes=512 * 2 ** 20):
+        self.memory = LRUCache(maxsize)
+        self.disk = DiskCache(path, max_bytes) if path is not None else None
+
+    @staticmethod
+    def key(img, template, version, **options):
+        """The cache key of recognizing `img` with a `DocTemplate` by a pipeline of the given version.
+        The `options` are everything else that changes the result, e.g. the OCR backend and the pipeline
+        parameters; their values must have a stable `repr`."""
+        options = ",".join("%s=%r" % item for item in sorted(options.items()))
+        return "%s:%s:%s:%s" % (image_digest(img), template.digest, version, options)
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return default if value is None else pickle.loads(value)
+
+    def put(self, key, value):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+
+class BlockCache(LRUCache):
+    """OCR results keyed by the block image content and the OCR settings. See `ocr.set_block_cache`."""
+
+    @staticmethod
+    def key(img, *settings):
+        return "%s:%s" % (image_digest(img), ":".join(map(str, settings)))
@@ -1,38 +1,174 @@
 import io
+import os
+import hashlib
+import threading
+import contextvars
 
 import cv2
 import json
 import numpy as np
-from pasportrecogniotion.util.ocr import ocr, ocreng
+from concurrent.futures import ThreadPoolExecutor
+from pasportrecogniotion.util.ocr import OCRResult, ocr_data, get_backend
+from pasportrecogniotion.util.profiling import span
 
 
-class DataBlock():
+class RecognitionCancelled(Exception):
+    """Raised when the recognition of a document is cancelled before all its blocks are recognized"""
+
+
+class WhitelistTable(dict):
+    """A `str.translate` table keeping the whitelisted characters and deleting all the others"""
+
+    def __init__(self, whitelist):
+        super(WhitelistTable, self).__init__((ord(c), ord(c)) for c in whitelist)
+
+    def __missing__(self, key):
+        return None
+
+
+class BlockTemplate(object):
+    """Immutable description of a document block: its geometry and OCR settings.
+    Shared between all the documents recognized with the same template.
+
+    The OCR settings are derived from the block type and size, unless the description gives them:
+    `lang` is eng for the MRZ and the "num" blocks, rus otherwise; `psm` is 7 (a single line) for
+    blocks up to `SINGLE_LINE` high, 6 (a block of text) for higher ones. The `whitelist` is passed
+    to the OCR engine, without the whitespace, which `whitespace_table` removes from the result
+    if the whitelist doesn't allow it."""
+
+    __slots__ = ['name', 'height', 'width', 'posX', 'posY', 'direction', 'type',
+                 'whitelist', 'whitelist_set', 'whitelist_table',
+                 'lang', 'psm', 'alt_psm', 'ocr_whitelist', 'whitespace_table']
+
+    SINGLE_LINE = 40
+
+    # Page segmentation modes to retry low-confidence blocks with: single column / raw line
+    ALT_PSM = {6: 4, 7: 13}
+
     def __init__(self, block, name):
-        self.height = block['height']
-        self.width = block['width']
-        self.posX = block['posX']
-        self.posY = block['posY']
-        self.direction = block['direction']
-        self.name = name
+        type = block.get('type', 'rus')
+        # The text height: the blocks turned to the right are rotated before the OCR
+        extent = block['height'] if block['direction'] == 'normal' else block['width']
+        psm = block.get('psm', 7 if extent <= self.SINGLE_LINE else 6)
+        values = dict(name=name,
+                      height=block['height'],
+                      width=block['width'],
+                      posX=block['posX'],
+                      posY=block['posY'],
+                      direction=block['direction'],
+                      type=block.get('type', 'rus'),
+                      whitelist=block['whitelist'],
+                      whitelist_set=frozenset(block['whitelist']),
+                      whitelist_table=WhitelistTable(block['whitelist']),
+                      lang=block.get('lang', 'eng' if type in ('eng', 'num') or name == 'MRZ' else 'rus'),
+                      psm=psm,
+                      alt_psm=self.ALT_PSM.get(psm, psm),
+                      ocr_whitelist="".join(c for c in block['whitelist'] if not c.isspace()) or None,
+                      whitespace_table=dict((ord(c), None) for c in " \n" if c not in block['whitelist']))
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("BlockTemplate is immutable")
+
+    def __reduce__(self):
+        # Pickled (e.g. for the worker processes) and copied as the description it is made from
+        return BlockTemplate, (self._block(), self.name)
+
+    def _block(self):
+        return dict((key, getattr(self, key)) for key in
+                    ('height', 'width', 'posX', 'posY', 'direction', 'type', 'whitelist', 'lang', 'psm'))
+
+    def replace(self, **changes):
+        """Returns a copy of the template with some of its settings (e.g. posX, height) changed"""
+        block = self._block()
+        block.update(changes)
+        return BlockTemplate(block, self.name)
+
+    @property
+    def bounds(self):
+        """(minX, minY, maxX, maxY) in template coordinates"""
+        return (self.posX, self.posY, self.posX + self.width, self.posY + self.height)
+
+
+class DataBlock():
+    """Per-document state of a block: the contours found in it and the recognized text.
+    The block geometry and settings are read from its `BlockTemplate`."""
+
+    # More expensive ways to read a block that is not recognized confidently enough, tried in order:
+    # (use the alternative page segmentation mode, upscale factor, binarization)
+    RETRIES = [(False, 2, 'otsu'), (True, 2, 'adaptive'), (False, 3, 'trunc')]
+
+    def __init__(self, template):
+        self.template = template
         self.data = []
         self.mrz = []
         self.images = []
-        self.whitelist = block['whitelist']
-
-    def recognize(self, img):
-
-        min_x, min_y, max_x, max_y = 10000, 10000, 0, 0
-        self.images.sort(key=lambda box: cv2.boundingRect(box)[1])
-        for box in self.images:
-            x, y, w, h = cv2.boundingRect(box)
-            max_y = max(max_y, h + y)
-            max_x = max(max_x, w + x)
-            min_x = min(min_x, x)
-            min_y = min(min_y, y)
-
-        ROI = img[min_y-10:max_y+10, min_x-10:max_x+10]
-        #ROI = img[y - 10:y + 10 + h, x - 10:x + 10 + w]
-        ROI = cv2.threshold(ROI, 210, 255, cv2.THRESH_TRUNC)[1]
+        self.words = []
+        self.confidence = None   # Of the least confident word, None if the OCR backend gives no confidences
+        self.retries = 0
+        self.recognized = False
+
+    def __getattr__(self, key):
+        if key == 'template':  # Not set yet, e.g. while unpickling
+            raise AttributeError(key)
+        return getattr(self.template, key)
+
+    def roi(self, img):
+        """Returns the region of `img` covering all the block contours with a 10px margin.
+        The region is a view of `img`, not a copy."""
+
+        rects = [cv2.boundingRect(box) for box in self.images]
+        order = sorted(range(len(rects)), key=lambda i: rects[i][1])
+        self.images = [self.images[i] for i in order]
+        if not rects:
+            return img[0:0, 0:0]
+
+        rects = np.array(rects)
+        min_x, min_y = rects[:, 0].min(), rects[:, 1].min()
+        max_x, max_y = (rects[:, 0] + rects[:, 2]).max(), (rects[:, 1] + rects[:, 3]).max()
+
+        return img[max(min_y - 10, 0):max_y + 10, max(min_x - 10, 0):max_x + 10]
+
+    def recognize(self, img, min_confidence=None, result=None):
+        """Recognizes the block text. `img` is only read, so the same page can be shared by all blocks.
+
+        :param min_confidence: If the text is recognized with a lower confidence, the block is read again
+                               with the `RETRIES` settings until one of them is confident enough.
+                               The most confident result is kept.
+        :param result: The `OCRResult` of the block read along with others, see `read_stitched`.
+                       The block is only read by itself if it needs retries.
+        """
+
+        with span(self.name, 'block'):
+            view = self.roi(img)
+            # Whether the engine got the block whitelist, so that only the whitespace is left to filter
+            exact = result is None and get_backend().supports_whitelist
+            if result is None:
+                result = self._read(view)
+            if min_confidence is not None and result.confidence is not None and result.confidence < min_confidence:
+                for alternative, upscale, binarization in self.RETRIES:
+                    self.retries += 1
+                    retry = self._read(view, self.alt_psm if alternative else self.psm, upscale, binarization)
+                    if retry.confidence is not None and retry.confidence > result.confidence:
+                        result = retry
+                        exact = get_backend().supports_whitelist
+                    if result.confidence >= min_confidence:
+                        break
+            self._store(result, self.whitespace_table if exact else self.whitelist_table)
+        self.recognized = True
+
+    def prepare(self, view, upscale=1, binarization='trunc'):
+        """The block region (see `roi`) as it is given to the OCR: scaled, binarized and turned upright"""
+        if upscale != 1:
+            view = cv2.resize(view, None, fx=upscale, fy=upscale, interpolation=cv2.INTER_CUBIC)
+        if binarization == 'otsu':
+            ROI = cv2.threshold(view, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+        elif binarization == 'adaptive':
+            ROI = cv2.adaptiveThreshold(view, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+        else:
+            ROI = np.empty_like(view)
+            cv2.threshold(view, 210, 255, cv2.THRESH_TRUNC, dst=ROI)
         if self.direction != 'normal':
             if self.direction == 'right':
                 ROI = cv2.rotate(ROI, cv2.ROTATE_90_COUNTERCLOCKWISE)
@@ -40,52 +176,310 @@ class DataBlock():
                 ROI = cv2.rotate(ROI, cv2.ROTATE_90_CLOCKWISE)
             else:
                 ROI = cv2.rotate(ROI, cv2.ROTATE_180)
+        return ROI
+
+    def _read(self, view, psm=None, upscale=1, binarization='trunc'):
+        if view.size == 0:
+            return ocr_data(view)
+        return ocr_data(self.prepare(view, upscale, binarization), self.lang, psm or self.psm, self.ocr_whitelist)
 
+    def _store(self, result, table):
+        text = result.text[0:-1].translate(table)
         if self.name != 'MRZ':
-            res = ocr(ROI, 'rus')
-            self.data.append("".join(filter(lambda x: x in self.whitelist, res[0:-1])))
+            self.data.append(text)
+        else:
+            self.mrz.append(text)
+        self.words.extend(result.words)
+        self.confidence = result.confidence
 
 
+def _words_to_text(words):
+    """Lays out words with boxes as lines of text, ending with a line break like the OCR output"""
+    lines = []
+    for word in sorted(words, key=lambda word: word.box[1] + word.box[3] / 2):
+        center = word.box[1] + word.box[3] / 2
+        line = lines[-1] if lines else None
+        if line is not None and center - line[0] < max(word.box[3], line[1]) / 2:
+            line[2].append(word)
         else:
-            res = ocreng(ROI, 'eng')
-            self.mrz.append("".join(filter(lambda x: x in self.whitelist, res[0:-1])))
+            lines.append([center, word.box[3], [word]])
+    return "".join(" ".join(word.text for word in sorted(line[2], key=lambda word: word.box[0])) + "\n"
+                   for line in lines)
+
+
+def read_stitched(items, gap=20):
+    """Reads many blocks with one OCR call per language: the prepared regions of the blocks
+    of the same language are stacked into one image, and the recognized words are given back
+    to the blocks by their position.
+
+    :param items: Pairs of `DataBlock` and the page image it is on; the blocks may be of different documents.
+    :param gap: Vertical space between the stacked regions, in pixels.
+    :return: An `OCRResult` with the words in block coordinates for every item, in the same order, or None
+             for the blocks that have to be read by themselves: the only block of its language, or blocks
+             of a backend that doesn't give word boxes.
+    """
+    results = [None] * len(items)
+    groups = {}  # lang -> indices of the items
+    for i, (block, img) in enumerate(items):
+        groups.setdefault(block.lang, []).append(i)
+
+    for lang, indices in groups.items():
+        rois = {}
+        for i in indices:
+            block, img = items[i]
+            view = block.roi(img)
+            if view.size == 0:
+                results[i] = ocr_data(view)
+            else:
+                rois[i] = block.prepare(view)
+        if len(rois) < 2:
+            continue
 
+        # Stack the regions top to bottom, on the background of the brightest one
+        offsets = {}
+        height = 0
+        for i, roi in rois.items():
+            offsets[i] = height
+            height += roi.shape[0] + gap
+        width = max(roi.shape[1] for roi in rois.values())
+        first = next(iter(rois.values()))
+        page = np.full((height - gap,) + (width,) + first.shape[2:], max(int(roi.max()) for roi in rois.values()),
+                       dtype=first.dtype)
+        for i, roi in rois.items():
+            page[offsets[i]:offsets[i] + roi.shape[0], :roi.shape[1]] = roi
 
+        whitelists = [items[i][0].ocr_whitelist for i in rois]
+        whitelist = None if None in whitelists else "".join(sorted(set("".join(whitelists))))
+        res = ocr_data(page, lang, 6, whitelist)
+        if any(word.box is None for word in res.words) or (res.text.strip() and not res.words):
+            continue
+
+        words = dict((i, []) for i in rois)
+        for word in res.words:
+            center = word.box[1] + word.box[3] / 2
+            for i in rois:
+                if offsets[i] <= center < offsets[i] + rois[i].shape[0]:
+                    left, top, w, h = word.box
+                    words[i].append(word._replace(box=(left, top - offsets[i], w, h)))
+                    break
+        for i in rois:
+            results[i] = OCRResult(_words_to_text(words[i]), words[i])
+
+    return results
+
+
+def load_description(file):
+    """Reads a document description (see tests/data/RusPass.json) into a dict."""
+    with io.open(file, encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
+class DocTemplate(object):
+    """Immutable parsed document description. Use `load_template` to get a cached instance."""
+
+    __slots__ = ['name', 'width', 'height', 'blocks', 'bounds', 'digest', '_source']
+
+    def __init__(self, data):
+        blocks = tuple(BlockTemplate(data['blocks'][name], name) for name in data['blocks'])
+        # (minX, minY, maxX, maxY) of every block in template coordinates, one row per block
+        bounds = np.array([b.bounds for b in blocks], dtype=np.float64).reshape(-1, 4)
+        bounds.setflags(write=False)
+
+        object.__setattr__(self, 'name', data['name'])
+        object.__setattr__(self, 'width', data['width'])
+        object.__setattr__(self, 'height', data['height'])
+        object.__setattr__(self, 'blocks', blocks)
+        object.__setattr__(self, 'bounds', bounds)
+        # The description, in its order of the blocks, to pickle the template with
+        object.__setattr__(self, '_source', json.dumps(data))
+        # Identifies the template content, e.g. in cache keys
+        object.__setattr__(self, 'digest', hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest())
+
+    def __setattr__(self, key, value):
+        raise AttributeError("DocTemplate is immutable")
+
+    def __reduce__(self):
+        return DocTemplate, (json.loads(self._source),)
+
+
+def assign_contours(rects, bounds, iws, ihs):
+    """Finds the rectangles whose centers lie strictly inside each block.
+
+    Rectangles with an area (in template units) not above 50 are ignored as noise.
+
+    :param rects: A list of `cv2.minAreaRect` results in image coordinates.
+    :param bounds: The `DocTemplate.bounds` matrix.
+    :param iws, ihs: Horizontal and vertical scale from template to image coordinates.
+    :return: A list with an array of rectangle indices for every row of `bounds`.
+    """
+    if not rects:
+        return [np.empty(0, dtype=np.intp) for _ in range(len(bounds))]
+
+    centers = np.array([r[0] for r in rects], dtype=np.float64) / (iws, ihs)
+    sizes = np.array([r[1] for r in rects], dtype=np.float64)
+    keep = sizes[:, 0] * sizes[:, 1] > 50 / iws / ihs
+
+    cx, cy = centers[:, 0], centers[:, 1]
+    inside = ((cx > bounds[:, 0, None]) & (cx < bounds[:, 2, None]) &
+              (cy > bounds[:, 1, None]) & (cy < bounds[:, 3, None]) & keep)
+
+    return [np.flatnonzero(row) for row in inside]
+
+
+_templates = {}  # Maps absolute path -> (mtime, DocTemplate)
+_templates_lock = threading.Lock()
+
+
+def load_template(file):
+    """Returns the parsed template of a document description.
+
+    Templates read from files are cached and reparsed only when the file modification time changes.
+
+    :param file: A path to the document description, a description dict or a `DocTemplate`.
+    """
+    if isinstance(file, DocTemplate):
+        return file
+    if isinstance(file, dict):
+        return DocTemplate(file)
+
+    path = os.path.abspath(file)
+    mtime = os.path.getmtime(path)
+    with _templates_lock:
+        cached = _templates.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    template = DocTemplate(load_description(path))
+    with _templates_lock:
+        _templates[path] = (mtime, template)
+    return template
 
 
 class DocDescription(object):
+    """Per-document extraction state over a shared `DocTemplate`"""
 
     def __init__(self, file):
-        data = {}
-        with io.open(file, encoding='utf-8') as json_file:
-            data = json.load(json_file)
-        self.width = data['width']
-        self.height = data['height']
+        """
+        :param file: A path to the document description, a description dict or a `DocTemplate`.
+        """
+        self.template = load_template(file)
+        self.width = self.template.width
+        self.height = self.template.height
+        self.name = self.template.name
         self.blocks = {}
-        for i in data['blocks']:
-            data_block = data['blocks'][i]
-            self.blocks[i] = (DataBlock(data_block, i))
-        self.name = data['name']
-
-    def extract_data(self, img, contours):
-        iws = img.shape[1] / self.width
-        ihs = img.shape[0] / self.height
-
-        rects = [cv2.minAreaRect(cont) for cont in (contours)]
-        for key in self.blocks:
-            block = self.blocks[key]
-            for i, c in enumerate(rects):
-                if c[1][1]*c[1][0] > 50 / iws / ihs:
-                    if ((c[0][1] / ihs > block.posY) and (
-                            c[0][1] / ihs < block.posY + block.height) and
-                            (c[0][0] / iws > block.posX) and (
-                                    c[0][0] / iws < block.posX + block.width)):
-                        box = cv2.boxPoints(c)  # cv2.boxPoints(rect) for OpenCV 3.x
-                        box = np.int0(box)
-                        block.images.append(box)
-            block.recognize(img.copy())
+        for block in self.template.blocks:
+            self.blocks[block.name] = DataBlock(block)
+        self.img = None
+        self.workers = None
+        self.progress = None
+        self.cancel = None
+        self.min_confidence = None
+        self.stitch = False
+        self.rects = []
+        self._points = {}  # Rect index -> box points, computed once even if the rect falls into several blocks
+
+    def assign(self, img, contours, workers=None, progress=None, cancel=None, min_confidence=None, stitch=False):
+        """Assigns the contours to the blocks, without recognizing them yet. The blocks are recognized
+        on demand: by `recognize`, or when taken with `description[name]`.
+
+        :param workers: If greater than 1, the blocks requested together are recognized concurrently
+                        by that many threads. The results are stored per block, so the order is kept.
+        :param progress: Called with every recognized `DataBlock`, possibly from the worker threads.
+        :param cancel: A `threading.Event`; once it is set, the remaining blocks are not recognized
+                       and `RecognitionCancelled` is raised.
+        :param min_confidence: Blocks recognized with a lower confidence (0-100) are read again with
+                               more expensive settings, see `DataBlock.recognize`.
+        :param stitch: Read the blocks requested together with one OCR call per language, see `read_stitched`.
+        """
+        self.img = img
+        self.workers = workers
+        self.progress = progress
+        self.cancel = cancel
+        self.min_confidence = min_confidence
+        self.stitch = stitch
+
+        self.rects = [cv2.minAreaRect(cont) for cont in (contours)]
+        self._points = {}
+        # A new page: forget the contours and text of the previous one
+        blocks = [DataBlock(self.blocks[block.name].template) for block in self.template.blocks]
+        bounds = np.array([block.template.bounds for block in blocks], dtype=np.float64).reshape(-1, 4)
+        for block, indices in zip(blocks, self._assign_contours(bounds)):
+            self._fill(block, indices)
+            self.blocks[block.name] = block
+
+    def _assign_contours(self, bounds):
+        iws = self.img.shape[1] / self.width
+        ihs = self.img.shape[0] / self.height
+        return assign_contours(self.rects, bounds, iws, ihs)
+
+    def _fill(self, block, indices):
+        for i in indices:
+            if i not in self._points:
+                self._points[i] = cv2.boxPoints(self.rects[i]).astype(np.int32)
+            block.images.append(self._points[i])
+
+    def update_block(self, name, **changes):
+        """Changes the settings of a block (e.g. its position after a manual correction) and reassigns
+        the page contours to it. Only this block has to be recognized again, the others keep their text.
+
+        :return: The new `DataBlock`, not recognized yet.
+        """
+        block = DataBlock(self.blocks[name].template.replace(**changes))
+        if self.img is not None:
+            bounds = np.array([block.template.bounds], dtype=np.float64)
+            self._fill(block, self._assign_contours(bounds)[0])
+        self.blocks[name] = block
+        return block
+
+    def retry(self, names):
+        """Recognizes the named blocks again, trying all the `DataBlock.RETRIES` settings
+        and keeping the most confident text, e.g. for the fields that failed their checks."""
+        for name in names:
+            self.update_block(name)
+        min_confidence, self.min_confidence = self.min_confidence, float('inf')
+        try:
+            self.recognize(names)
+        finally:
+            self.min_confidence = min_confidence
+
+    def recognize(self, names=None):
+        """Recognizes the named blocks (all by default) that are not recognized yet."""
+        blocks = [self.blocks[name] for name in (self.blocks if names is None else names)]
+        blocks = [block for block in blocks if not block.recognized]
+
+        def recognize(block, result):
+            if self.cancel is not None and self.cancel.is_set():
+                raise RecognitionCancelled()
+            block.recognize(self.img, self.min_confidence, result)
+            if self.progress is not None:
+                self.progress(block)
+
+        results = [None] * len(blocks)
+        if self.stitch and len(blocks) > 1:
+            if self.cancel is not None and self.cancel.is_set():
+                raise RecognitionCancelled()
+            results = read_stitched([(block, self.img) for block in blocks])
+
+        if self.workers is not None and self.workers > 1 and len(blocks) > 1:
+            # Each task runs in a copy of the caller's context, so that active profiling hooks see it
+            contexts = [contextvars.copy_context() for _ in blocks]
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(lambda block, result, context: context.run(recognize, block, result),
+                                  blocks, results, contexts))
+        else:
+            for block, result in zip(blocks, results):
+                recognize(block, result)
 
+    def __getitem__(self, name):
+        """Returns the named block, recognizing it first if needed."""
+        self.recognize([name])
+        return self.blocks[name]
 
+    def extract_data(self, img, contours, workers=None, progress=None, cancel=None, min_confidence=None,
+                     stitch=False):
+        """Assigns the contours to the blocks and recognizes every block. See `assign`."""
+        self.assign(img, contours, workers, progress, cancel, min_confidence, stitch)
+        self.recognize()
 
     def show(self, img=None):
         # Function for debuging
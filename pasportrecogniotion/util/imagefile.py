@@ -0,0 +1,276 @@
+'''
+PassportEye::Util: Loading of the scanned images.
+
+The recognition needs only the grayscale image, so the scans are decoded straight to grayscale
+(a JPEG is then decoded without its color planes) instead of loading BGR and converting it.
+A `LazyImage` keeps the encoded file, memory mapped or wrapped without copying, and decodes it
+only when the pixels are first needed, once for everyone using it:
+
+    img = load_image("scan.jpg")
+    preview = img.reduced(4)           # The JPEG is decoded at 1/4 of its size
+    data = recognise_doc(img, "tests/data/RusPass.json")
+    img.gray                           # The image the pipeline decoded, not decoded again
+
+`iter_pages` lazily yields the pages of multi-page TIFF and PDF scans as LazyImages.
+PDF pages are rendered with PyMuPDF, which has to be installed for that.
+
+License: MIT
+'''
+
+import hashlib
+import mmap
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+# Downscale factor -> OpenCV flag decoding the image to grayscale at that size
+REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def read_buffer(source, use_mmap=True):
+    """The encoded image as a uint8 array, without copying it: a file is memory mapped (or read, without
+    `use_mmap`), and bytes-like objects (bytes, bytearray, memoryview, mmap) are wrapped as they are."""
+    if not isinstance(source, str):
+        return np.frombuffer(source, np.uint8)
+    with open(source, 'rb') as f:
+        if not use_mmap:
+            return np.frombuffer(f.read(), np.uint8)
+        try:
+            # The mapping stays open while the array uses it, closing the file doesn't unmap it
+            return np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), np.uint8)
+        except ValueError:  # An empty file can't be mapped
+            return np.empty(0, np.uint8)
+
+
+# Whether cv2.imdecodemulti takes the range of the pages to decode
+_decode_range = True
+
+
+def decode_gray(buffer, factor=1, page=None):
+    """Decodes an encoded image to grayscale, downscaled by `factor` (1, 2, 4 or 8). Returns None if
+    the image can't be decoded. JPEG images are downscaled while decoding, which saves the memory and
+    the time of a full decode and a resize.
+
+    :param page: The index of the page to decode from a multi-page image (TIFF), the first page if None.
+    """
+    if buffer.size == 0:
+        return None
+    global _decode_range
+    if page is None:
+        return cv2.imdecode(buffer, REDUCED_GRAYSCALE[factor])
+    if _decode_range:
+        try:
+            ok, mats = cv2.imdecodemulti(buffer, REDUCED_GRAYSCALE[factor], None, (page, page + 1))
+            return mats[0] if ok and mats else None
+        except TypeError:
+            _decode_range = False
+    # Older OpenCV releases can't decode a range of the pages: decode them all
+    ok, mats = cv2.imdecodemulti(buffer, REDUCED_GRAYSCALE[factor])
+    return mats[page] if ok and page < len(mats) else None
+
+
+class _FileDigest(object):
+    """The hash of an encoded file, computed once for all its pages"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        with self._lock:
+            if self._value is None:
+                self._value = hashlib.sha1(self.buffer).hexdigest()
+            return self._value
+
+
+class LazyImage(object):
+    """An encoded image file, decoded to grayscale when the pixels are first needed.
+
+    The decoded image is kept and shared by all the users of the LazyImage (e.g. the recognition
+    pipeline and the GUI showing the scan), which may ask for it from different threads."""
+
+    def __init__(self, source, use_mmap=True, page=None, name=None, file_digest=None):
+        """
+        :param source: An image file name, or the encoded file as bytes, bytearray, memoryview or mmap.
+        :param use_mmap: Map the file into memory instead of reading it.
+        :param page: The index of the page of a multi-page file, see `iter_pages`.
+        :param file_digest: The hash of the file shared by its pages.
+        """
+        self.buffer = read_buffer(source, use_mmap)
+        self.page = page
+        self.name = name or (source if isinstance(source, str) else "<%d bytes>" % self.buffer.size)
+        self._file = file_digest or _FileDigest(self.buffer)
+        self._gray = None
+        self._digest = None
+        self._lock = threading.Lock()
+
+    @property
+    def gray(self):
+        """The full resolution grayscale image. Raises IOError if the file can't be decoded."""
+        with self._lock:
+            if self._gray is None:
+                img = self._decode(1)
+                if img is None:
+                    raise IOError("Cannot read image %s" % self.name)
+                self._gray = img
+            return self._gray
+
+    @property
+    def digest(self):
+        """A hash of the encoded file, to look the image up in caches without decoding it"""
+        if self._digest is None:
+            digest = self._file.value
+            self._digest = digest if self.page is None else "%s:%d" % (digest, self.page)
+        return self._digest
+
+    def reduced(self, factor):
+        """A grayscale copy downscaled by `factor` (1, 2, 4 or 8). Decoded separately, unless the full
+        image is decoded already, which is then resized instead. Raises IOError if the file can't be decoded."""
+        if factor == 1:
+            return self.gray
+        if self._gray is not None:
+            return cv2.resize(self._gray, None, fx=1.0 / factor, fy=1.0 / factor, interpolation=cv2.INTER_AREA)
+        img = self._decode(factor)
+        if img is None:
+            raise IOError("Cannot read image %s" % self.name)
+        return img
+
+    def _decode(self, factor):
+        return decode_gray(self.buffer, factor, self.page)
+
+    def __getstate__(self):
+        # Sent to the worker processes encoded, to be decoded there
+        return self.buffer, self.page, self.name
+
+    def __setstate__(self, state):
+        self.buffer, self.page, self.name = state
+        self._file = _FileDigest(self.buffer)
+        self._gray = None
+        self._digest = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "LazyImage(%r)" % self.name
+
+
+# PyMuPDF documents must not be used by several threads at once
+_pdf_lock = threading.Lock()
+
+
+def _open_pdf(buffer):
+    if fitz is None:
+        raise ImportError("PDF scans require the PyMuPDF package")
+    with _pdf_lock:
+        return fitz.open(stream=buffer.tobytes(), filetype='pdf')
+
+
+class PDFPage(LazyImage):
+    """A page of a PDF document, rendered to grayscale at `dpi` when the pixels are first needed.
+    `buffer` is the whole PDF file, sent along with the page number to the worker processes."""
+
+    def __init__(self, buffer, document, page, dpi=200, name=None, file_digest=None):
+        self.buffer = buffer
+        self.document = document
+        self.page = page
+        self.dpi = dpi
+        self.name = name or "page %d" % (page + 1)
+        self._file = file_digest or _FileDigest(buffer)
+        self._gray = None
+        self._digest = None
+        self._lock = threading.Lock()
+
+    @property
+    def digest(self):
+        """A hash of the PDF file, the page number and the rendering resolution"""
+        if self._digest is None:
+            self._digest = "%s:%d:%d" % (self._file.value, self.page, self.dpi)
+        return self._digest
+
+    def __getstate__(self):
+        return self.buffer, self.page, self.dpi, self.name
+
+    def __setstate__(self, state):
+        buffer, page, dpi, name = state
+        self.__init__(buffer, _open_pdf(buffer), page, dpi, name)
+
+    def _decode(self, factor):
+        with _pdf_lock:
+            pixmap = self.document[self.page].get_pixmap(dpi=self.dpi // factor, colorspace=fitz.csGRAY)
+            img = np.frombuffer(pixmap.samples, np.uint8).reshape(pixmap.height, pixmap.stride)
+        return img[:, :pixmap.width]
+
+
+def tiff_page_count(buffer):
+    """The number of pages of a TIFF file, read from its directory chain without decoding any of them.
+    None if the buffer is not a (classic, not BigTIFF) TIFF file."""
+    header = buffer[:8].tobytes()
+    if len(header) < 8 or header[:4] not in (b'II*\x00', b'MM\x00*'):
+        return None
+    order = '<' if header[:2] == b'II' else '>'
+    count = 0
+    offset = struct.unpack(order + 'I', header[4:])[0]
+    seen = set()
+    while offset and offset not in seen and offset + 2 <= buffer.size:
+        seen.add(offset)
+        count += 1
+        entries = struct.unpack(order + 'H', buffer[offset:offset + 2].tobytes())[0]
+        next_offset = offset + 2 + 12 * entries
+        if next_offset + 4 > buffer.size:
+            break
+        offset = struct.unpack(order + 'I', buffer[next_offset:next_offset + 4].tobytes())[0]
+    return count
+
+
+def iter_pages(source, dpi=200, use_mmap=True):
+    """Lazily yields the pages of a scan as `LazyImage`s: every page of a multi-page TIFF or PDF file,
+    or the image itself. Nothing is decoded until the pixels of a page are needed.
+
+    :param source: An image or PDF file name, an encoded file (bytes-like), a LazyImage or a decoded image.
+    :param dpi: The resolution PDF pages are rendered at.
+    """
+    if isinstance(source, (np.ndarray, LazyImage)):
+        yield source
+        return
+    buffer = read_buffer(source, use_mmap)
+    name = source if isinstance(source, str) else "<%d bytes>" % buffer.size
+    file_digest = _FileDigest(buffer)
+    if buffer[:5].tobytes() == b'%PDF-':
+        document = _open_pdf(buffer)
+        with _pdf_lock:
+            count = document.page_count
+        for page in range(count):
+            yield PDFPage(buffer, document, page, dpi, "%s#%d" % (name, page + 1), file_digest)
+        return
+    count = tiff_page_count(buffer)
+    if count is None or count < 2:
+        yield LazyImage(buffer, name=name, file_digest=file_digest)
+        return
+    for page in range(count):
+        yield LazyImage(buffer, page=page, name="%s#%d" % (name, page + 1), file_digest=file_digest)
+
+
+def load_image(source, use_mmap=True):
+    """Wraps an image file name or an encoded image (bytes-like) into a `LazyImage`.
+    A decoded image (numpy array) or a LazyImage is returned as is."""
+    if isinstance(source, (np.ndarray, LazyImage)):
+        return source
+    return LazyImage(source, use_mmap)
+
+
+def to_array(img):
+    """The pixels of a decoded image or a `LazyImage`, decoding it if needed"""
+    return img.gray if isinstance(img, LazyImage) else img
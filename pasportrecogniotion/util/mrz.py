@@ -0,0 +1,148 @@
+'''
+PassportEye::Util: Parsing of the machine readable zone of the russian passport.
+
+The MRZ of the russian internal passport follows ICAO 9303 TD3 (two lines of 44 characters),
+with the cyrillic names transliterated by a fixed one-to-one table and the series, issue date
+and department code stored in the optional data:
+
+    PNRUSIM8REK<<EVGENIQ<ALEKSANDROVI3<<<<<<<<<<
+    1100000000RUS8209120M<<<<<<<4041217292000<46
+
+    >>> check_digit('110000000')
+    0
+    >>> mrz = parse_mrz("PNRUSIM8REK<<EVGENIQ<ALEKSANDROVI3<<<<<<<<<<"
+    ...                 "1100000000RUS8209120M<<<<<<<4041217292000<46")
+    >>> mrz.valid
+    True
+    >>> mrz.fields['lastName'], mrz.fields['name'], mrz.fields['midName']
+    ('ИМЯРЕК', 'ЕВГЕНИЙ', 'АЛЕКСАНДРОВИЧ')
+    >>> mrz.fields['serial'], mrz.fields['number'], mrz.fields['dateBirth'], mrz.fields['dataExtradition']
+    ('1104', '000000', '12.09.1982', '17.12.2004')
+
+License: MIT
+'''
+
+import datetime
+
+# Latin (and digit) characters of the russian passport MRZ -> cyrillic letters
+TRANSLITERATION = {
+    'A': 'А', 'B': 'Б', 'V': 'В', 'G': 'Г', 'D': 'Д', 'E': 'Е', '2': 'Ё', 'J': 'Ж', 'Z': 'З', 'I': 'И',
+    'Q': 'Й', 'K': 'К', 'L': 'Л', 'M': 'М', 'N': 'Н', 'O': 'О', 'P': 'П', 'R': 'Р', 'S': 'С', 'T': 'Т',
+    'U': 'У', 'F': 'Ф', 'H': 'Х', 'C': 'Ц', '3': 'Ч', '4': 'Ш', 'W': 'Щ', 'X': 'Ъ', 'Y': 'Ы', '9': 'Ь',
+    '6': 'Э', '7': 'Ю', '8': 'Я',
+}
+
+# Letters that OCR often reads instead of digits, for the fields that contain only digits
+_DIGITS = str.maketrans('OQDIL|ZSBG', '0001112586')
+
+SEX = {'M': 'МУЖ.', 'F': 'ЖЕН.'}
+
+# PassportData attributes that can be read from the MRZ
+ATTRIBUTES = frozenset(['serial', 'number', 'dateBirth', 'male', 'dataExtradition', 'code',
+                        'lastName', 'name', 'midName'])
+
+# The attributes covered by a check digit. The sex and the names are only accepted along with the checked ones.
+CHECK_DIGIT_ATTRIBUTES = frozenset(['serial', 'number', 'dateBirth', 'dataExtradition', 'code'])
+
+
+def check_digit(data):
+    """ICAO 9303 check digit: weights 7, 3, 1; digits count as is, letters A-Z as 10-35 and '<' as 0."""
+    total = 0
+    for i, c in enumerate(data):
+        if c.isdigit():
+            value = int(c)
+        elif 'A' <= c <= 'Z':
+            value = ord(c) - ord('A') + 10
+        else:
+            value = 0
+        total += value * (7, 3, 1)[i % 3]
+    return total % 10
+
+
+def _checked(data, digit):
+    return digit.isdigit() and check_digit(data) == int(digit)
+
+
+def _date(yymmdd):
+    """DD.MM.YYYY of a YYMMDD date, taking the century that puts it in the past"""
+    try:
+        year, month, day = int(yymmdd[0:2]), int(yymmdd[2:4]), int(yymmdd[4:6])
+        year += 2000 if 2000 + year <= datetime.date.today().year else 1900
+        return datetime.date(year, month, day).strftime('%d.%m.%Y')
+    except ValueError:
+        return None
+
+
+def transliterate(name):
+    """Cyrillic spelling of a MRZ name ('<' separates words), or None if it has characters outside the table."""
+    try:
+        return " ".join("".join(TRANSLITERATION[c] for c in word) for word in name.split('<'))
+    except KeyError:
+        return None
+
+
+def split_lines(text):
+    """Finds the two 44 character lines in the OCR output of the MRZ, which may lack the line breaks."""
+    text = text.replace(' ', '')
+    lines = [line for line in text.splitlines() if len(line) >= 30]
+    if len(lines) < 2:
+        text = "".join(text.split())
+        start = text.find('PN')
+        text = text[max(start, 0):]
+        if len(text) < 88:
+            return None
+        lines = [text[:44], text[44:88]]
+    return [(line + '<' * 44)[:44] for line in lines[-2:]]
+
+
+class MRZData(object):
+    """The parsed MRZ: `fields` maps PassportData attributes to their values, and `checked` lists the
+    attributes whose values are confirmed by check digits (the sex is accepted when the composite check
+    passes and the names when all checks pass, see `CHECK_DIGIT_ATTRIBUTES`)."""
+
+    def __init__(self, line1, line2):
+        self.lines = [line1, line2]
+        # Everything but the nationality and the sex is digits or fillers
+        line2 = line2[:10].translate(_DIGITS) + line2[10:13] + line2[13:20].translate(_DIGITS) + line2[20] + \
+            line2[21:].translate(_DIGITS)
+        self.fields = {}
+        self.checked = set()
+
+        number, optional = line2[0:9], line2[28:42]
+        self.number_valid = _checked(number, line2[9])
+        self.birth_valid = _checked(line2[13:19], line2[19])
+        self.optional_valid = _checked(optional, line2[42])
+        self.composite_valid = _checked(line2[0:10] + line2[13:20] + line2[21:43], line2[43])
+        self.valid = self.number_valid and self.birth_valid and self.optional_valid and self.composite_valid
+
+        self.fields['serial'] = number[0:3] + optional[0]
+        self.fields['number'] = number[3:9]
+        self.fields['dateBirth'] = _date(line2[13:19])
+        self.fields['male'] = SEX.get(line2[20])
+        self.fields['dataExtradition'] = _date(optional[1:7])
+        self.fields['code'] = optional[7:13]
+
+        names = line1[5:].rstrip('<').split('<<', 1)
+        given = names[1].split('<', 1) if len(names) > 1 else ['']
+        self.fields['lastName'] = transliterate(names[0])
+        self.fields['name'] = transliterate(given[0])
+        self.fields['midName'] = transliterate(given[1]) if len(given) > 1 else None
+
+        if self.number_valid and self.optional_valid:
+            self.checked.update(['serial', 'number'])
+        if self.birth_valid and self.fields['dateBirth'] is not None:
+            self.checked.add('dateBirth')
+        if self.optional_valid and self.fields['dataExtradition'] is not None:
+            self.checked.update(['dataExtradition', 'code'])
+        if self.composite_valid and self.fields['male'] is not None:
+            self.checked.add('male')
+        if self.valid and line1.startswith('PNRUS'):
+            self.checked.update(attr for attr in ('lastName', 'name', 'midName') if self.fields[attr])
+
+
+def parse_mrz(text):
+    """Parses the OCR output of the russian passport MRZ. Returns `MRZData` or None if no MRZ is found."""
+    lines = split_lines(text)
+    if lines is None:
+        return None
+    return MRZData(*lines)
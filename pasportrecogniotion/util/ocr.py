@@ -1,48 +1,324 @@
 '''
-PassportEye::Util: Interface between SKImage and the PyTesseract OCR
-NB: You must have the "tesseract" tool present in your path for this to work.
+PassportEye::Util: Interface between SKImage and the Tesseract OCR
+NB: You must have the "tesseract" tool present in your path (pytesseract backend)
+or the tesserocr package installed (tesserocr backend) for this to work.
 
 Author: Dziuba Alexandr
 License: MIT
 '''
 
-import tempfile
+import functools
+import os
+import threading
+from collections import namedtuple
 import numpy as np
-from imageio import imwrite
 from pytesseract import pytesseract
+from pasportrecogniotion.util.profiling import span
 
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
-def ocr(img, lang='rus',whitelist = ""):
 
-    if img is None or img.shape[-1] == 0:  # Issue #34
-        return ''
-    # Prevent annoying warning about lossy conversion to uint8
-    if str(img.dtype).startswith('float') and np.nanmin(img) >= 0 and np.nanmax(img) <= 1:
-        img = img.astype(np.float64) * (np.power(2.0, 8) - 1) + 0.499999999
-        img = img.astype(np.uint8)
+# A recognized word: its text, confidence (0-100) and (left, top, width, height) box, None if unknown
+Word = namedtuple('Word', ['text', 'confidence', 'box'])
 
-    config = ("--psm 6 ")
 
-    res = pytesseract.image_to_string(img,
-                              lang=lang,
-                              config=config)
+class OCRResult(object):
+    """The text recognized in an image along with its words"""
 
-    return res
+    __slots__ = ['text', 'words']
 
-def ocreng(img, lang='eng'):
+    def __init__(self, text, words=()):
+        self.text = text
+        self.words = list(words)
 
-    if img is None or img.shape[-1] == 0:  # Issue #34
-        return ''
+    @property
+    def confidence(self):
+        """Confidence of the least confident word, None if the backend gives no confidences"""
+        confidences = [word.confidence for word in self.words if word.confidence is not None]
+        return min(confidences) if confidences else None
+
+    def __repr__(self):
+        return "OCRResult(%r, confidence=%r)" % (self.text, self.confidence)
+
+
+class OCRBackend(object):
+    """Base class for the OCR engines used by `ocr`.
+
+    A backend is created once and reused for every block of every document,
+    so implementations are free to keep expensive state (loaded models) around.
+
+    A `whitelist` restricts the characters the engine may recognize. Backends that
+    can't do that leave `supports_whitelist` False and never get one."""
+
+    name = None
+    supports_whitelist = False
+
+    @property
+    def key(self):
+        """Identifies the backend along with the settings that change its results, e.g. in cache keys"""
+        return self.name
+
+    def factory(self):
+        """A picklable callable creating a backend with the same settings, e.g. in worker processes"""
+        return type(self)
+
+    def image_to_string(self, img, lang, psm=6, whitelist=None):
+        raise NotImplementedError
+
+    def image_to_data(self, img, lang, psm=6, whitelist=None):
+        """Returns an `OCRResult`. Backends that can tell word confidences override this."""
+        if whitelist:
+            return OCRResult(self.image_to_string(img, lang, psm, whitelist))
+        return OCRResult(self.image_to_string(img, lang, psm))
+
+    def close(self):
+        """Releases the resources held by the backend."""
+        pass
+
+
+class PyTesseractBackend(OCRBackend):
+    """Runs a separate `tesseract` process for every call. Slow, but needs nothing except the binary."""
+
+    name = 'pytesseract'
+    supports_whitelist = True
+
+    @staticmethod
+    def _config(psm, whitelist):
+        if not whitelist:
+            return "--psm %d" % psm
+        return "--psm %d -c tessedit_char_whitelist=%s" % (psm, whitelist)
+
+    @property
+    def key(self):
+        return "%s(%s)" % (self.name, pytesseract.tesseract_cmd)
+
+    def image_to_string(self, img, lang, psm=6, whitelist=None):
+        return pytesseract.image_to_string(img, lang=lang, config=self._config(psm, whitelist))
+
+    def image_to_data(self, img, lang, psm=6, whitelist=None):
+        data = pytesseract.image_to_data(img, lang=lang, config=self._config(psm, whitelist),
+                                         output_type=pytesseract.Output.DICT)
+        words = []
+        lines = {}  # (block, paragraph, line) -> words of the line, in order
+        for i, text in enumerate(data['text']):
+            confidence = float(data['conf'][i])
+            if confidence < 0 or not text.strip():
+                continue
+            words.append(Word(text, confidence,
+                              (data['left'][i], data['top'][i], data['width'][i], data['height'][i])))
+            lines.setdefault((data['block_num'][i], data['par_num'][i], data['line_num'][i]), []).append(text)
+        text = "".join(" ".join(line) + "\n" for line in lines.values())
+        return OCRResult(text, words)
+
+
+class TesserocrBackend(OCRBackend):
+    """Keeps initialized Tesseract API handles per language in-process,
+    so the traineddata is loaded once instead of on every call.
+
+    A handle is used by one thread at a time; concurrent callers get extra handles
+    for the same language, which are then kept warm for reuse."""
+
+    name = 'tesserocr'
+    supports_whitelist = True
+
+    def __init__(self, path=None):
+        if tesserocr is None:
+            raise ImportError("The tesserocr backend requires the tesserocr package")
+        self.path = path
+        self._free = {}              # lang -> list of idle api handles
+        self._all = []
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        return "%s(%s)" % (self.name, self.path)
+
+    def factory(self):
+        return functools.partial(type(self), self.path)
+
+    def _acquire(self, lang):
+        with self._lock:
+            idle = self._free.setdefault(lang, [])
+            if idle:
+                return idle.pop()
+        kwargs = {'lang': lang}
+        if self.path is not None:
+            kwargs['path'] = self.path
+        api = tesserocr.PyTessBaseAPI(**kwargs)
+        with self._lock:
+            self._all.append(api)
+        return api
+
+    def _release(self, lang, api):
+        with self._lock:
+            self._free.setdefault(lang, []).append(api)
+
+    def _recognize(self, api, img, psm, whitelist):
+        img = np.ascontiguousarray(img)
+        height, width = img.shape[:2]
+        bpp = 1 if img.ndim == 2 else img.shape[2]
+        api.SetPageSegMode(psm)
+        # The handles are shared by all the blocks: always set the whitelist, empty meaning any character
+        api.SetVariable("tessedit_char_whitelist", whitelist or "")
+        api.SetImageBytes(img.tobytes(), width, height, bpp, width * bpp)
+        return api.GetUTF8Text()
+
+    def image_to_string(self, img, lang, psm=6, whitelist=None):
+        api = self._acquire(lang)
+        try:
+            return self._recognize(api, img, psm, whitelist)
+        finally:
+            self._release(lang, api)
+
+    def image_to_data(self, img, lang, psm=6, whitelist=None):
+        api = self._acquire(lang)
+        try:
+            text = self._recognize(api, img, psm, whitelist)
+            words = []
+            level = tesserocr.RIL.WORD
+            for word in tesserocr.iterate_level(api.GetIterator(), level):
+                box = word.BoundingBox(level)
+                if box is None:
+                    continue
+                left, top, right, bottom = box
+                words.append(Word(word.GetUTF8Text(level), word.Confidence(level),
+                                  (left, top, right - left, bottom - top)))
+            return OCRResult(text, words)
+        finally:
+            self._release(lang, api)
+
+    def close(self):
+        with self._lock:
+            for api in self._all:
+                api.End()
+            self._free = {}
+            self._all = []
+
+
+class StubBackend(OCRBackend):
+    """Returns a fixed text without running any OCR. Used to benchmark the image processing stages."""
+
+    name = 'stub'
+
+    def __init__(self, text='', confidence=None):
+        self.text = text
+        self.confidence = confidence
+
+    @property
+    def key(self):
+        return "%s(%r, %r)" % (self.name, self.text, self.confidence)
+
+    def factory(self):
+        return functools.partial(type(self), self.text, self.confidence)
+
+    def image_to_string(self, img, lang, psm=6, whitelist=None):
+        return self.text
+
+    def image_to_data(self, img, lang, psm=6, whitelist=None):
+        return OCRResult(self.text, [Word(word, self.confidence, None) for word in self.text.split()])
+
+
+BACKENDS = {
+    PyTesseractBackend.name: PyTesseractBackend,
+    TesserocrBackend.name: TesserocrBackend,
+    StubBackend.name: StubBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+_block_cache = None
+
+
+def register_backend(name, factory):
+    """Makes an OCR backend class (or any factory returning an `OCRBackend`) selectable by name."""
+    BACKENDS[name] = factory
+
+
+def set_backend(backend):
+    """Selects the OCR backend used by `ocr`.
+
+    :param backend: A backend name from `BACKENDS`, an `OCRBackend` instance or None
+                    to go back to the default choice.
+    """
+    global _backend
+    if isinstance(backend, str):
+        backend = BACKENDS[backend]()
+    with _backend_lock:
+        if _backend is not None and _backend is not backend:
+            _backend.close()
+        _backend = backend
+
+
+def get_backend():
+    """Returns the current OCR backend, creating the default one on first use.
+
+    The default is taken from the RUSPASSPORT_OCR_BACKEND environment variable, otherwise
+    tesserocr is used when it is installed, with pytesseract as the fallback."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = os.environ.get('RUSPASSPORT_OCR_BACKEND')
+            if name is None:
+                name = TesserocrBackend.name if tesserocr is not None else PyTesseractBackend.name
+            _backend = BACKENDS[name]()
+        return _backend
+
+
+def set_block_cache(cache):
+    """Makes `ocr` reuse the results for identical images, e.g. unchanged blocks of resubmitted pages.
+
+    :param cache: A `cache.BlockCache`, or None to disable caching.
+    """
+    global _block_cache
+    _block_cache = cache
+
+
+def _prepare(img):
     # Prevent annoying warning about lossy conversion to uint8
     if str(img.dtype).startswith('float') and np.nanmin(img) >= 0 and np.nanmax(img) <= 1:
         img = img.astype(np.float64) * (np.power(2.0, 8) - 1) + 0.499999999
         img = img.astype(np.uint8)
+    return img
 
-    config = ("--psm 6")
 
-    res = pytesseract.image_to_string(img,
-                              lang=lang,
-                              config=config)
+def ocr_data(img, lang='rus', psm=6, whitelist=None):
+    """Recognizes the image, returning an `OCRResult` with the word confidences.
 
+    :param psm: Tesseract page segmentation mode, e.g. 6 for a block of text or 7 for a single line.
+    :param whitelist: The only characters to recognize (no whitespace). Ignored by the backends
+                      that don't support it, so the caller still has to filter their output.
+    """
+
+    if img is None or img.shape[-1] == 0:  # Issue #34
+        return OCRResult('')
+
+    backend = get_backend()
+    if not backend.supports_whitelist:
+        whitelist = None
+    cache = _block_cache
+    if cache is not None:
+        key = cache.key(img, backend.key, lang, psm, whitelist)
+        res = cache.get(key)
+        if res is not None:
+            return res
+
+    with span('ocr:' + lang, 'ocr', (img,)):
+        if whitelist:
+            res = backend.image_to_data(_prepare(img), lang, psm=psm, whitelist=whitelist)
+        else:
+            res = backend.image_to_data(_prepare(img), lang, psm=psm)
+
+    if cache is not None:
+        cache.put(key, res)
     return res
 
+
+def ocr(img, lang='rus', whitelist=""):
+    return ocr_data(img, lang, whitelist=whitelist or None).text
+
+
+def ocreng(img, lang='eng'):
+    return ocr(img, lang)
@@ -5,6 +5,25 @@ Author: Konstantin Tretyakov
 License: MIT
 '''
 
+import contextvars
+import itertools
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import numpy as np
+
+from pasportrecogniotion.util import profiling
+from pasportrecogniotion.util.cache import image_digest
+
+
+def fingerprint(value):
+    """Identifies the content of a pipeline input: arrays are hashed, strings and numbers compared by value.
+    Any other object gets a new fingerprint every time, as it may have been changed in place."""
+    if isinstance(value, np.ndarray):
+        return image_digest(value)
+    if value is None or isinstance(value, (str, bytes, int, float, bool)):
+        return (type(value).__name__, value)
+    return object()
+
 
 class Pipeline(object):
     """
@@ -37,14 +56,70 @@ class Pipeline(object):
     (4, 0)
     >>> a['d']
     0
+
+    Computed values are memoized by the fingerprints of the component inputs and parameters, and every
+    change invalidates only the values downstream of it. A component whose inputs are the same as the last
+    time is not called again:
+
+    >>> calls = []
+    >>> b = Pipeline()
+    >>> b.add_component('square', lambda x: calls.append(x) or x * x, ['x2'], ['x'])
+    >>> b.add_component('inc', lambda x2: x2 + 1, ['y'], ['x2'])
+    >>> b.set_input('x', 3)
+    >>> b['y'], calls
+    (10, [3])
+    >>> b.set_input('x', 4)
+    >>> b['y'], calls
+    (17, [3, 4])
+    >>> b.set_input('x', 4)
+    >>> b.invalidate('x2')
+    >>> b['y'], calls
+    (17, [3, 4])
+
+    With an executor, components that don't depend on each other are computed concurrently:
+
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> with ThreadPoolExecutor(2) as executor:
+    ...     c = Pipeline(executor)
+    ...     c.add_component('1', lambda: 1, ['a'], [])
+    ...     c.add_component('2', lambda: 2, ['b'], [])
+    ...     c.add_component('s', lambda x, y: x + y, ['s'], ['a', 'b'])
+    ...     c.evaluate()
+    >>> c['s']
+    3
+
+    Components depending on each other in a cycle can't be computed:
+
+    >>> d = Pipeline()
+    >>> d.add_component('x', lambda y: y, ['x'], ['y'])
+    >>> d.add_component('y', lambda x: x, ['y'], ['x'])
+    >>> d['x']
+    Traceback (most recent call last):
+    ...
+    Exception: Cyclic dependencies between components x, y
     """
 
-    def __init__(self):
+    def __init__(self, executor=None, process_executor=None):
+        """
+        :param executor: A `concurrent.futures` executor (normally a ThreadPoolExecutor, as OpenCV and
+                         tesseract release the GIL) to run independent components concurrently.
+                         Components are run one by one in the calling thread if None.
+        :param process_executor: A ProcessPoolExecutor for the components declaring `__cpu_bound__ = True`.
+                                 Such components and their inputs and outputs must be picklable.
+        """
+        self.executor = executor
+        self.process_executor = process_executor
         self.data = dict()        # Maps key -> data item.
         self.components = dict()  # Maps name -> component
         self.provides = dict()    # Component name -> provides list
         self.depends = dict()     # Component name -> depends list
         self.whoprovides = dict() # key -> component name
+        self.hooks = []           # Profiling hooks, see pasportrecogniotion.util.profiling
+        self.consumers = dict()   # key -> names of the components that depend on it
+        self.fingerprints = dict()  # key -> fingerprint of the current value
+        self.revisions = dict()   # Component name -> revision, renewed when it is added or its parameters change
+        self._revision = itertools.count()
+        self.memo = dict()        # Component name -> (fingerprint of its inputs, results)
         self.data['__data__'] = self.data
         self.data['__pipeline__'] = self
 
@@ -53,6 +128,7 @@ class Pipeline(object):
         Add a given callable to a list of components. The provides and depends are lists of strings, specifying what
         keys the component computes and what keys it requires to be present. If those are not given, the callable must
         have fields __provides__ and __depends__.
+        Components declaring `__cpu_bound__ = True` run in the `process_executor`, if the pipeline has one.
         """
         provides = provides or getattr(callable, '__provides__', [])
         depends = depends or getattr(callable, '__depends__', [])
@@ -62,8 +138,15 @@ class Pipeline(object):
         self.provides[name] = provides
         self.depends[name] = depends
         self.components[name] = callable
+        self.revisions[name] = next(self._revision)
         for p in provides:
             self.whoprovides[p] = name
+        for d in depends:
+            self.consumers.setdefault(d, set()).add(name)
+
+    def add_hook(self, hook):
+        """Reports the timing of every component computed by this pipeline to a `profiling.Hook`."""
+        self.hooks.append(hook)
 
     def remove_component(self, name):
         """Removes an existing component with a given name, invalidating all the values computed by
@@ -71,7 +154,11 @@ class Pipeline(object):
         if name not in self.components:
             raise Exception("No component named %s" % name)
         del self.components[name]
+        for d in self.depends[name]:
+            self.consumers[d].discard(name)
         del self.depends[name]
+        del self.revisions[name]
+        self.memo.pop(name, None)
         for p in self.provides[name]:
             del self.whoprovides[p]
             self.invalidate(p)
@@ -85,33 +172,158 @@ class Pipeline(object):
 
     def invalidate(self, key):
         """Remove the given data item along with all items that depend on it in the graph."""
-        if key not in self.data:
+        stack = [key]
+        seen = set(stack)
+        while stack:
+            key = stack.pop()
+            self.data.pop(key, None)
+            self.fingerprints.pop(key, None)
+            for cname in self.consumers.get(key, ()):
+                for downstream_key in self.provides[cname]:
+                    if downstream_key not in seen:
+                        seen.add(downstream_key)
+                        stack.append(downstream_key)
+
+    def touch(self, key):
+        """Tells that the value of `key` was changed in place: the values computed from it are invalidated."""
+        self.fingerprints[key] = object()
+        for cname in self.consumers.get(key, ()):
+            for downstream_key in self.provides[cname]:
+                self.invalidate(downstream_key)
+
+    def set_input(self, key, value):
+        """Sets an input value that no component provides. If it differs from the current one,
+        the values computed from it are invalidated."""
+        if key in self.whoprovides:
+            raise Exception("%s is provided by component %s" % (key, self.whoprovides[key]))
+        fp = fingerprint(value)
+        if key in self.data and self.fingerprints.get(key) == fp:
             return
-        del self.data[key]
+        self.invalidate(key)
+        self.data[key] = value
+        self.fingerprints[key] = fp
 
-        # Find all components that used it and invalidate their results
-        for cname in self.components:
-            if key in self.depends[cname]:
-                for downstream_key in self.provides[cname]:
-                    self.invalidate(downstream_key)
+    def update_params(self, name, **params):
+        """Sets attributes of the named component, invalidating the values it computed and their successors."""
+        component = self.components[name]
+        for key, value in params.items():
+            setattr(component, key, value)
+        self.revisions[name] = next(self._revision)
+        for p in self.provides[name]:
+            self.invalidate(p)
 
     def __setitem__(self, key, value):
         self.data[key] = value
+        self.fingerprints[key] = object()
 
     def __getitem__(self, key):
         self._compute(key)
         return self.data[key]
 
-    def _compute(self, key):
-        if key not in self.data:
+    def schedule(self, *keys):
+        """Names of the components to call to compute the `keys`, in topological order.
+        Raises an exception if the components depend on each other in a cycle."""
+        order = []
+        visited = set()
+        active = []  # The components whose dependencies are being scheduled, outermost first
+        stack = [(key, False) for key in reversed(keys)]
+        while stack:
+            key, expanded = stack.pop()
+            if key in self.data:
+                continue
             cname = self.whoprovides[key]
-            for d in self.depends[cname]:
-                self._compute(d)
-            inputs = [self.data[d] for d in self.depends[cname]]
-            results = self.components[cname](*inputs)
-            if len(self.provides[cname]) == 1:
-                self.data[self.provides[cname][0]] = results
-            else:
-                for k, v in zip(self.provides[cname], results):
-                    self.data[k] = v
+            if expanded:
+                if cname not in visited:
+                    visited.add(cname)
+                    order.append(cname)
+                    active.remove(cname)
+            elif cname in active:
+                raise Exception("Cyclic dependencies between components %s"
+                                % ", ".join(active[active.index(cname):]))
+            elif cname not in visited:
+                active.append(cname)
+                stack.append((key, True))
+                stack.extend((d, False) for d in reversed(self.depends[cname]))
+        return order
+
+    def evaluate(self, *keys):
+        """Computes the given keys (everything the components provide by default) at once.
+        With an executor, all the components that don't depend on each other run concurrently."""
+        self._compute(*(keys or self.whoprovides))
+
+    def _compute(self, *keys):
+        order = self.schedule(*keys)
+        if self.executor is None or len(order) < 2:
+            for cname in order:
+                self._call(cname)
+        else:
+            self._compute_parallel(order)
+
+    def _compute_parallel(self, order):
+        waiting = list(order)
+        running = {}  # future -> (component name, fingerprint)
+        try:
+            while waiting or running:
+                # Start every component whose inputs are ready; memoized ones may make others ready at once
+                ready = [cname for cname in waiting if all(d in self.data for d in self.depends[cname])]
+                while ready:
+                    for cname in ready:
+                        waiting.remove(cname)
+                        inputs, fp = self._inputs(cname)
+                        memo = self.memo.get(cname)
+                        if memo is not None and memo[0] == fp:
+                            self._store(cname, fp, memo[1])
+                        else:
+                            context = contextvars.copy_context()
+                            running[self.executor.submit(context.run, self._run, cname, inputs)] = (cname, fp)
+                    ready = [cname for cname in waiting if all(d in self.data for d in self.depends[cname])]
+                if not running:
+                    if waiting:
+                        raise Exception("Cyclic dependencies between components %s" % ", ".join(waiting))
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    cname, fp = running.pop(future)
+                    results = future.result()
+                    self.memo[cname] = (fp, results)
+                    self._store(cname, fp, results)
+        finally:
+            for future in running:
+                future.cancel()
+
+    def _inputs(self, cname):
+        inputs = [self.data[d] for d in self.depends[cname]]
+        # A component's outputs are identified by the fingerprints of everything they were computed from
+        fp = (cname, self.revisions[cname]) + tuple(self.fingerprints.get(d) for d in self.depends[cname])
+        return inputs, fp
+
+    def _run(self, cname, inputs):
+        component = self.components[cname]
+        with profiling.profile(*self.hooks):
+            with profiling.span(cname, 'component', inputs) as span:
+                if self.process_executor is not None and getattr(component, '__cpu_bound__', False):
+                    # The component and its inputs are pickled to a worker process
+                    results = self.process_executor.submit(component, *inputs).result()
+                else:
+                    results = component(*inputs)
+                if span is not None:
+                    span.set_outputs(results)
+        return results
+
+    def _call(self, cname):
+        inputs, fp = self._inputs(cname)
+        memo = self.memo.get(cname)
+        if memo is not None and memo[0] == fp:
+            results = memo[1]
+        else:
+            results = self._run(cname, inputs)
+            self.memo[cname] = (fp, results)
+        self._store(cname, fp, results)
 
+    def _store(self, cname, fp, results):
+        if len(self.provides[cname]) == 1:
+            results = [results]
+        for k, v in zip(self.provides[cname], results):
+            self.data[k] = v
+            self.fingerprints[k] = (k, fp)
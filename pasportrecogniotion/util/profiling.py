@@ -0,0 +1,187 @@
+'''
+PassportEye::Util: Timing of the pipeline components and of the OCR calls.
+
+Nothing is measured unless hooks are active. Hooks are activated for a block of code with `profile`
+(covering every pipeline created inside it, e.g. by `recognise_doc`), or attached to a single
+pipeline with `Pipeline.add_hook`:
+
+    >>> stats = StageStats()
+    >>> with profile(stats):
+    ...     with span('work'):
+    ...         pass
+    >>> stats.stats['work']['calls']
+    1
+
+License: MIT
+'''
+
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+_active_hooks = contextvars.ContextVar('pasportrecogniotion_profiling_hooks', default=())
+
+
+def nbytes(value):
+    """Total size of the numpy arrays in a value (possibly nested in tuples, lists or dicts)."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    return 0
+
+
+class Span(object):
+    """A single timed call: a pipeline component, a block recognition or an OCR call."""
+
+    __slots__ = ['name', 'category', 'args', 'pid', 'tid', 'start', 'end', 'cpu_start', 'cpu_end',
+                 'input_bytes', 'output_bytes']
+
+    def __init__(self, name, category, inputs, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+        self.input_bytes = nbytes(inputs)
+        self.output_bytes = 0
+        self.start = self.end = time.perf_counter()
+        self.cpu_start = self.cpu_end = time.thread_time()
+
+    def set_outputs(self, outputs):
+        self.output_bytes = nbytes(outputs)
+
+    @property
+    def wall(self):
+        return self.end - self.start
+
+    @property
+    def cpu(self):
+        return self.cpu_end - self.cpu_start
+
+
+class Hook(object):
+    """Base class for the profiling hooks. Hooks may be called from several threads at once."""
+
+    def start(self, span):
+        pass
+
+    def finish(self, span):
+        pass
+
+
+class CallbackHook(Hook):
+    """Calls `callback(span)` for every finished span."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def finish(self, span):
+        self.callback(span)
+
+
+class StageStats(Hook):
+    """Aggregates call count, wall and CPU time and input/output sizes per span name."""
+
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def finish(self, span):
+        with self._lock:
+            s = self.stats.setdefault(span.name, dict(category=span.category, calls=0, wall=0.0, cpu=0.0,
+                                                      input_bytes=0, output_bytes=0))
+            s['calls'] += 1
+            s['wall'] += span.wall
+            s['cpu'] += span.cpu
+            s['input_bytes'] += span.input_bytes
+            s['output_bytes'] += span.output_bytes
+
+    def as_dict(self):
+        with self._lock:
+            return {name: dict(s) for name, s in self.stats.items()}
+
+    def __str__(self):
+        lines = ["%-24s %-10s %6s %10s %10s" % ('name', 'category', 'calls', 'wall, s', 'cpu, s')]
+        for name, s in sorted(self.as_dict().items(), key=lambda item: -item[1]['wall']):
+            lines.append("%-24s %-10s %6d %10.4f %10.4f" % (name, s['category'], s['calls'], s['wall'], s['cpu']))
+        return "\n".join(lines)
+
+
+class TraceRecorder(Hook):
+    """Records every span, to be saved as a plain JSON trace or in the Chrome trace event format
+    (viewable in chrome://tracing or Perfetto)."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def finish(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def events(self):
+        with self._lock:
+            spans = list(self.spans)
+        return [dict(name=s.name, category=s.category, pid=s.pid, tid=s.tid, start=s.start, wall=s.wall,
+                     cpu=s.cpu, input_bytes=s.input_bytes, output_bytes=s.output_bytes, args=s.args)
+                for s in spans]
+
+    def chrome_trace(self):
+        events = []
+        for e in self.events():
+            args = dict(e['args'], cpu=e['cpu'], input_bytes=e['input_bytes'], output_bytes=e['output_bytes'])
+            events.append(dict(name=e['name'], cat=e['category'], ph='X', pid=e['pid'], tid=e['tid'],
+                               ts=e['start'] * 1e6, dur=e['wall'] * 1e6, args=args))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_json(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.events(), f, ensure_ascii=False, default=str)
+
+    def save_chrome_trace(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f, ensure_ascii=False, default=str)
+
+
+@contextmanager
+def profile(*hooks):
+    """Activates the hooks, in addition to the already active ones, for the enclosed code
+    and the pipelines it runs."""
+    token = _active_hooks.set(_active_hooks.get() + tuple(hooks))
+    try:
+        yield hooks[0] if len(hooks) == 1 else hooks
+    finally:
+        _active_hooks.reset(token)
+
+
+def active_hooks():
+    return _active_hooks.get()
+
+
+@contextmanager
+def span(name, category='component', inputs=(), **args):
+    """Times the enclosed code and reports it to the active hooks. Yields the `Span`, or None
+    when profiling is off. Extra keyword arguments are stored in `Span.args`."""
+    hooks = _active_hooks.get()
+    if not hooks:
+        yield None
+        return
+
+    s = Span(name, category, inputs, args)
+    for hook in hooks:
+        hook.start(s)
+    try:
+        yield s
+    finally:
+        s.end = time.perf_counter()
+        s.cpu_end = time.thread_time()
+        for hook in hooks:
+            hook.finish(s)
@@ -31,5 +31,8 @@ setup(name='RusPasport',
       include_package_data=True,
       zip_safe=False,
       install_requires=['numpy','cv2', 'PyQt5', 'pytesseract >= 0.2.0'],
+      extras_require={'tesserocr': ['tesserocr'], 'parquet': ['pyarrow'], 'pdf': ['PyMuPDF']},
+      entry_points={'console_scripts': ['ruspassport-stream = pasportrecogniotion.stream:main',
+                                        'ruspassport-service = pasportrecogniotion.service:main']},
 
      )
@@ -0,0 +1,176 @@
+'''
+Benchmark of the recognition pipeline.
+
+Measures per-stage and end-to-end latency of recognise_doc, the peak memory of a single
+recognition and the throughput of recognise_batch for several numbers of workers. The inputs
+are the images in tests/data and synthetic passports rendered from the RusPass.json layout
+at several resolutions. Results are printed and saved as JSON, to compare runs.
+
+    python -m tests.benchmark --ocr stub --heights 900 1800 3600 --output bench.json
+
+With `--ocr stub` no OCR is done at all, which isolates the image processing stages.
+'''
+
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from pkg_resources import resource_filename
+
+from pasportrecogniotion.image import recognise_doc, recognise_batch
+from pasportrecogniotion.util import profiling
+from pasportrecogniotion.util.docdescription import load_template
+from pasportrecogniotion.util.ocr import BACKENDS, set_backend
+
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+file = lambda fn: resource_filename('tests', 'data/%s' % fn)
+
+
+def max_rss_kb(children=False):
+    """The peak resident memory of this process (or of its finished children) in KiB, None if unknown.
+    Without the resource module (Windows) it is taken from psutil, which can't tell it for the children."""
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS
+        return rss // 1024 if sys.platform == 'darwin' else rss
+    if psutil is None or children:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss) // 1024
+
+
+def render_passport(template, height, seed=0):
+    """Draws a passport-like page: black text lines inside every block of the template."""
+    rnd = np.random.RandomState(seed)
+    k = height / template.height
+    img = np.full((height, int(template.width * k), 3), 235, np.uint8)
+    font_scale = 0.45 * k
+    thickness = max(1, int(round(k)))
+    line_height = int(18 * k)
+
+    for block in template.blocks:
+        x, y = int(block.posX * k), int(block.posY * k)
+        w, h = int(block.width * k), int(block.height * k)
+        right = block.direction == 'right'
+        if right:
+            w, h = h, w
+        canvas = np.full((h, w, 3), 235, np.uint8)
+        alphabet = "0123456789" if block.type == 'num' else "ABCDEFGHIKLMNOPRSTUXYZ<"
+        for line_y in range(line_height, h - line_height // 3, line_height):
+            text = "".join(rnd.choice(list(alphabet), size=max(1, w // int(12 * k + 1))))
+            cv2.putText(canvas, text, (int(4 * k), line_y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (20, 20, 20),
+                        thickness, cv2.LINE_AA)
+        if right:
+            canvas = cv2.rotate(canvas, cv2.ROTATE_90_CLOCKWISE)
+        img[y:y + canvas.shape[0], x:x + canvas.shape[1]] = canvas[:img.shape[0] - y, :img.shape[1] - x]
+
+    return img
+
+
+def bench_latency(img, doc, repeat, options):
+    """End-to-end and per-stage latency of recognise_doc, and the peak memory of one call."""
+    stats = profiling.StageStats()
+    times = []
+    recognise_doc(img, doc, **options)  # warm-up: template cache, OCR engine
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with profiling.profile(stats):
+            recognise_doc(img, doc, **options)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    recognise_doc(img, doc, **options)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    stages = {name: dict(s, wall_mean=s['wall'] / s['calls'], cpu_mean=s['cpu'] / s['calls'])
+              for name, s in stats.as_dict().items()}
+    return dict(shape=list(img.shape), repeat=repeat,
+                latency=dict(mean=statistics.mean(times), median=statistics.median(times),
+                             min=min(times), max=max(times)),
+                peak_traced_bytes=peak, stages=stages)
+
+
+def bench_throughput(paths, doc, workers, options):
+    # The batch is parallel over documents: the blocks of a document are recognized sequentially
+    options = {key: value for key, value in options.items() if key != 'workers'}
+    start = time.perf_counter()
+    failed = sum(1 for res in recognise_batch(paths, doc, workers=workers, **options) if res.error is not None)
+    elapsed = time.perf_counter() - start
+    return dict(workers=workers, documents=len(paths), failed=failed, seconds=elapsed,
+                docs_per_sec=len(paths) / elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ocr', default='stub', choices=sorted(BACKENDS), help="OCR backend (default: stub)")
+    parser.add_argument('--heights', type=int, nargs='*', default=[900, 1800, 3600],
+                        help="page heights of the synthetic passports, in pixels")
+    parser.add_argument('--repeat', type=int, default=5, help="recognitions per image for the latency")
+    parser.add_argument('--workers', type=int, nargs='*', default=[1, 2, 4],
+                        help="worker counts for the throughput, empty to skip it")
+    parser.add_argument('--batch-size', type=int, default=32, help="documents per throughput run")
+    parser.add_argument('--block-workers', type=int, default=None, help="threads per document")
+    parser.add_argument('--work-scale', type=float, default=None, help="reduced localization resolution")
+    parser.add_argument('--output', default=None, help="JSON file to save the results to")
+    args = parser.parse_args(argv)
+
+    set_backend(args.ocr)
+    doc = file("RusPass.json")
+    template = load_template(doc)
+    options = dict(workers=args.block_workers, work_scale=args.work_scale)
+
+    images = {os.path.basename(path): cv2.imread(path) for path in sorted(glob.glob(file("*.jpg")))}
+    for height in args.heights:
+        images['synthetic_%d' % height] = render_passport(template, height)
+
+    results = dict(python=platform.python_version(), opencv=cv2.__version__, platform=platform.platform(),
+                   cpu_count=os.cpu_count(), args=vars(args), latency={}, throughput={})
+
+    for name, img in images.items():
+        res = bench_latency(img, doc, args.repeat, options)
+        results['latency'][name] = res
+        print("%-20s %-16s mean %.4fs  median %.4fs  peak %.1f MB" % (
+            name, "x".join(map(str, img.shape)), res['latency']['mean'], res['latency']['median'],
+            res['peak_traced_bytes'] / 2 ** 20))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, img in images.items():
+            path = os.path.join(tmp, name + '.png')
+            cv2.imwrite(path, img)
+            paths = [path] * args.batch_size
+            results['throughput'][name] = []
+            for workers in args.workers:
+                res = bench_throughput(paths, doc, workers, options)
+                results['throughput'][name].append(res)
+                print("%-20s workers %-3d %.2f docs/s" % (name, workers, res['docs_per_sec']))
+
+    results['max_rss_kb'] = max_rss_kb()
+    results['max_rss_children_kb'] = max_rss_kb(children=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
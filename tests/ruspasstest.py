@@ -2,7 +2,8 @@ import cv2
 from pkg_resources import resource_filename
 from pytesseract import pytesseract
 
-from pasportrecogniotion.image import recognise_doc
+from pasportrecogniotion.image import recognise_doc, recognise_batch
+from pasportrecogniotion.pages import recognise_pages
 from pasportrecogniotion.util.docdescription import DocDescription
 
 
@@ -12,6 +13,16 @@ def testview():
     file = lambda fn : resource_filename('tests', 'data/%s' % fn)
     recognise_doc(cv2.imread(file("pas3.jpg")), file("RusPass.json"))
 
+def testbatch():
+    file = lambda fn : resource_filename('tests', 'data/%s' % fn)
+    for res in recognise_batch([file("pas1.jpg"), file("missing.jpg")], file("RusPass.json"), workers=2):
+        assert (res.data is None) == (res.index == 1)
+
+def testpages():
+    file = lambda fn : resource_filename('tests', 'data/%s' % fn)
+    for res in recognise_pages(file("pas1.jpg"), file("RusPass.json")):
+        assert res.index == 0 and res.error is None
+
 def testPassDescription():
     file = lambda fn: resource_filename('tests', 'data/%s' % fn)
     docdescr = DocDescription(file("RusPass.json"))
@@ -0,0 +1,28 @@
+import pickle
+
+import cv2
+from pkg_resources import resource_filename
+
+from pasportrecogniotion.image import recognise_batch
+from pasportrecogniotion.util.ocr import StubBackend, set_backend
+
+file = lambda fn: resource_filename('tests', 'data/%s' % fn)
+
+
+def teardown_function(function):
+    set_backend(None)
+
+
+def testbackendfactory():
+    backend = StubBackend("АААА\n", 90.0)
+    copy = pickle.loads(pickle.dumps(backend.factory()))()
+    assert copy is not backend and copy.key == backend.key
+
+
+def testbatchbackend():
+    # The workers must recognize with the configured backend, not a default one of the same name
+    set_backend(StubBackend("АААА\n", 90.0))
+    img = cv2.imread(file("pas1.jpg"))
+    results = list(recognise_batch([img, img], file("RusPass.json"), workers=2))
+    assert sorted(r.index for r in results) == [0, 1]
+    assert all(r.error is None and r.data.name == "АААА" for r in results)
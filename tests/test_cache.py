@@ -0,0 +1,73 @@
+import time
+
+import cv2
+from pkg_resources import resource_filename
+
+from pasportrecogniotion.image import recognise_doc
+from pasportrecogniotion.util.cache import DiskCache, ResultCache
+from pasportrecogniotion.util.ocr import StubBackend, set_backend
+
+file = lambda fn: resource_filename('tests', 'data/%s' % fn)
+
+
+class CountingBackend(StubBackend):
+    """Stub OCR counting its calls"""
+
+    def __init__(self, text):
+        super(CountingBackend, self).__init__(text, 90.0)
+        self.calls = 0
+
+    def image_to_data(self, img, lang, psm=6, whitelist=None):
+        self.calls += 1
+        return super(CountingBackend, self).image_to_data(img, lang, psm, whitelist)
+
+
+def teardown_function(function):
+    set_backend(None)
+
+
+def testresultcachehit():
+    img, cache = cv2.imread(file("pas1.jpg")), ResultCache()
+    backend = CountingBackend("АААА")
+    set_backend(backend)
+    first = recognise_doc(img, file("RusPass.json"), cache=cache)
+    calls = backend.calls
+    assert calls > 0
+    assert recognise_doc(img, file("RusPass.json"), cache=cache) == first
+    assert backend.calls == calls
+
+
+def testresultcacheoptions():
+    img, cache = cv2.imread(file("pas1.jpg")), ResultCache()
+    set_backend(StubBackend("АААА\n", 90.0))
+    cached = recognise_doc(img, file("RusPass.json"), cache=cache)
+    assert cached.name == "АААА"
+
+    # Another backend, or other options, must not get the cached result
+    set_backend(StubBackend("ББББ\n", 90.0))
+    assert recognise_doc(img, file("RusPass.json"), cache=cache).name == "ББББ"
+    backend = CountingBackend("ББББ\n")
+    set_backend(backend)
+    for options in [dict(min_confidence=50), dict(work_scale=1.5), dict(stitch=True)]:
+        calls = backend.calls
+        recognise_doc(img, file("RusPass.json"), cache=cache, **options)
+        assert backend.calls > calls, options
+
+
+def testdiskcacheeviction(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.db"), max_bytes=250)
+    cache.put("a", b"a" * 100)
+    time.sleep(0.01)
+    cache.put("b", b"b" * 100)
+    time.sleep(0.01)
+    assert cache.get("a") == b"a" * 100  # Now the most recently used
+    time.sleep(0.01)
+    cache.put("c", b"c" * 100)
+    assert cache.get("b") is None
+    assert cache.get("a") == b"a" * 100 and cache.get("c") == b"c" * 100
+
+
+def testdiskcachepersists(tmp_path):
+    path = str(tmp_path / "cache.db")
+    ResultCache(path=path).put("key", {"value": 1})
+    assert ResultCache(path=path).get("key") == {"value": 1}
@@ -0,0 +1,57 @@
+import pickle
+
+import cv2
+import numpy as np
+from pkg_resources import resource_filename
+
+from pasportrecogniotion.util import imagefile
+from pasportrecogniotion.util.imagefile import iter_pages, tiff_page_count, read_buffer
+
+file = lambda fn: resource_filename('tests', 'data/%s' % fn)
+
+
+def write_tiff(path, count):
+    img = cv2.imread(file("pas1.jpg"), cv2.IMREAD_GRAYSCALE)
+    pages = [np.roll(img, 10 * page, axis=1) for page in range(count)]
+    assert cv2.imwritemulti(path, pages)
+    return pages
+
+
+def testtiffpages(tmp_path):
+    path = str(tmp_path / "scan.tiff")
+    pages = write_tiff(path, 3)
+    assert tiff_page_count(read_buffer(path)) == 3
+
+    scanned = list(iter_pages(path))
+    assert [page.name for page in scanned] == ["%s#%d" % (path, i) for i in (1, 2, 3)]
+    assert all(page._gray is None for page in scanned)  # Nothing decoded yet
+    for page, expected in zip(scanned, pages):
+        assert np.array_equal(page.gray, expected)
+    assert len(set(page.digest for page in scanned)) == 3
+
+
+def testtiffpagepickle(tmp_path):
+    path = str(tmp_path / "scan.tiff")
+    pages = write_tiff(path, 2)
+    page = list(iter_pages(path))[1]
+    copy = pickle.loads(pickle.dumps(page))
+    assert copy.name == page.name and copy.digest == page.digest
+    assert np.array_equal(copy.gray, pages[1])
+
+
+def testsinglepage():
+    scanned = list(iter_pages(file("pas1.jpg")))
+    assert len(scanned) == 1 and scanned[0].page is None
+    assert scanned[0].gray.shape == cv2.imread(file("pas1.jpg"), cv2.IMREAD_GRAYSCALE).shape
+
+
+def testoldopencv(tmp_path, monkeypatch):
+    # cv2.imdecodemulti without the range argument decodes all the pages
+    imdecodemulti = cv2.imdecodemulti
+    monkeypatch.setattr(cv2, 'imdecodemulti', lambda buf, flags: imdecodemulti(buf, flags))
+    monkeypatch.setattr(imagefile, '_decode_range', True)
+    path = str(tmp_path / "scan.tiff")
+    pages = write_tiff(path, 3)
+    scanned = list(iter_pages(path))
+    assert np.array_equal(scanned[2].gray, pages[2])
+    assert not imagefile._decode_range
@@ -0,0 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+from pkg_resources import resource_filename
+
+from pasportrecogniotion.image import recognise_doc, MRZPipeline
+from pasportrecogniotion.util.ocr import StubBackend, set_backend
+
+file = lambda fn: resource_filename('tests', 'data/%s' % fn)
+
+
+def setup_function(function):
+    set_backend(StubBackend("АААА\n", 90.0))
+
+
+def teardown_function(function):
+    set_backend(None)
+
+
+def testexecutor():
+    img = cv2.imread(file("pas1.jpg"))
+    expected = recognise_doc(img, file("RusPass.json"))
+    with ThreadPoolExecutor(2) as executor:
+        assert recognise_doc(img, file("RusPass.json"), executor=executor) == expected
+        pipeline = MRZPipeline(img, file("RusPass.json"), executor=executor)
+        assert pipeline.executor is executor and pipeline.result == expected
@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+from pkg_resources import resource_filename
+
+from pasportrecogniotion.service import RecognitionService, HTTPService
+from pasportrecogniotion.util.ocr import StubBackend, set_backend
+
+file = lambda fn: resource_filename('tests', 'data/%s' % fn)
+
+
+def setup_function(function):
+    set_backend(StubBackend("АААА\n", 90.0))
+
+
+def teardown_function(function):
+    set_backend(None)
+
+
+def scan(extra=b''):
+    # Trailing bytes after the JPEG make another file with the same picture
+    with open(file("pas1.jpg"), 'rb') as f:
+        return f.read() + extra
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 60))
+
+
+def testrecognise():
+    async def recognise():
+        async with RecognitionService(file("RusPass.json"), processes=2) as service:
+            return await service.recognise(scan())
+
+    assert run(recognise()).name == "АААА"
+
+
+def testcoalesce():
+    async def recognise():
+        async with RecognitionService(file("RusPass.json"), processes=2) as service:
+            results = await asyncio.gather(*[service.recognise(scan()) for _ in range(3)])
+            return results, service.metrics_dict()
+
+    results, metrics = run(recognise())
+    assert [data.name for data in results] == ["АААА"] * 3
+    assert metrics['requests'] == 3 and metrics['coalesced'] == 2 and metrics['batches'] == 1
+
+
+def testbatching():
+    async def recognise():
+        async with RecognitionService(file("RusPass.json"), processes=1, max_batch=8) as service:
+            results = await asyncio.gather(*[service.recognise(scan(b'\0' * i)) for i in range(6)])
+            return results, service.metrics_dict()
+
+    results, metrics = run(recognise())
+    assert len(results) == 6 and metrics['coalesced'] == 0
+    assert metrics['batches'] < 6 and metrics['mean_batch_size'] > 1
+
+
+def testhttp():
+    async def request(port, head, body=b''):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(head + b'Content-Length: %d\r\n\r\n' % len(body) + body)
+        await writer.drain()
+        # The reply ends when the server closes the connection
+        response = await asyncio.wait_for(reader.read(), 10)
+        writer.close()
+        status, _, content = response.partition(b'\r\n\r\n')
+        return int(status.split()[1]), json.loads(content.decode('utf-8'))
+
+    async def serve():
+        async with RecognitionService(file("RusPass.json"), processes=2) as service:
+            http = HTTPService(service)
+            server = await http.start('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return [await request(port, b'POST /recognize HTTP/1.0\r\n', scan()),
+                        await request(port, b'POST /recognize HTTP/1.0\r\n', b'nonsense'),
+                        await request(port, b'GET /metrics HTTP/1.0\r\n'),
+                        await request(port, b'GET /nowhere HTTP/1.0\r\n')]
+            finally:
+                await http.close()
+
+    recognized, failed, metrics, missing = run(serve())
+    assert recognized[0] == 200 and recognized[1]["passport data"]["Имя"] == "АААА"
+    assert failed[0] == 400
+    assert metrics[0] == 200 and metrics[1]['requests'] == 2 and metrics[1]['errors'] == 1
+    assert missing[0] == 404
@@ -0,0 +1,80 @@
+import numpy as np
+
+from pasportrecogniotion.util.docdescription import BlockTemplate, DataBlock, read_stitched
+from pasportrecogniotion.util.ocr import OCRBackend, OCRResult, StubBackend, Word, set_backend
+
+
+class InkBackend(OCRBackend):
+    """Stub OCR reading every run of dark rows as one word, its text being the height of the run.
+    The boxes are where the rows are, so that the words can be given back to the stacked blocks."""
+
+    name = 'ink'
+
+    def __init__(self):
+        self.calls = []
+
+    def image_to_string(self, img, lang, psm=6, whitelist=None):
+        return self.image_to_data(img, lang, psm).text
+
+    def image_to_data(self, img, lang, psm=6, whitelist=None):
+        self.calls.append((img.shape, lang))
+        ink = (img < 128).any(axis=1)
+        words, top = [], None
+        for y, dark in enumerate(list(ink) + [False]):
+            if dark and top is None:
+                top = y
+            elif not dark and top is not None:
+                columns = np.nonzero((img[top:y] < 128).any(axis=0))[0]
+                words.append(Word(str(y - top), 90.0,
+                                  (int(columns[0]), top, int(columns[-1] - columns[0] + 1), y - top)))
+                top = None
+        return OCRResult("".join(word.text + "\n" for word in words), words)
+
+
+def block(name, x, y, lines, lang='rus'):
+    """A block on the page with a dark bar of the given height for every line of text"""
+    template = BlockTemplate(dict(height=100, width=200, posX=x, posY=y, direction='normal',
+                                  whitelist="0123456789", lang=lang), name)
+    result = DataBlock(template)
+    top = y
+    for height in lines:
+        result.images.append(np.array([[x, top], [x + 150, top], [x + 150, top + height], [x, top + height]],
+                                      np.int32))
+        top += height + 8
+    return result
+
+
+def page(blocks):
+    img = np.full((600, 800), 255, np.uint8)
+    for item in blocks:
+        for contour in item.images:
+            x0, y0 = contour.min(axis=0)
+            x1, y1 = contour.max(axis=0)
+            img[y0:y1, x0:x1] = 0
+    return img
+
+
+def teardown_function(function):
+    set_backend(None)
+
+
+def testdemultiplex():
+    backend = InkBackend()
+    set_backend(backend)
+    blocks = [block("A", 50, 50, [12]), block("B", 300, 200, [20, 6]), block("C", 50, 400, [15]),
+              block("MRZ", 300, 400, [9], lang='eng')]
+    img = page(blocks)
+    results = read_stitched([(item, img) for item in blocks])
+
+    # One call for the three russian blocks; the only english one is left to be read by itself
+    assert [lang for shape, lang in backend.calls] == ['rus']
+    assert [result.text if result else None for result in results] == ["12\n", "20\n6\n", "15\n", None]
+    # The boxes are in the coordinates of the block regions, 10px margin included
+    assert [word.box for word in results[1].words] == [(10, 10, 150, 20), (10, 38, 150, 6)]
+
+
+def testnoboxes():
+    set_backend(StubBackend("1234\n", 90.0))
+    blocks = [block("A", 50, 50, [12]), block("B", 300, 200, [20])]
+    img = page(blocks)
+    assert read_stitched([(item, img) for item in blocks]) == [None, None]
@@ -0,0 +1,72 @@
+import queue
+import random
+import threading
+import time
+
+import cv2
+from pkg_resources import resource_filename
+
+from pasportrecogniotion.stream import iter_sources, recognise_stream
+from pasportrecogniotion.util.ocr import StubBackend, set_backend
+
+file = lambda fn: resource_filename('tests', 'data/%s' % fn)
+
+
+class SlowBackend(StubBackend):
+    """Stub OCR taking a random time, so that the documents complete out of order"""
+
+    def image_to_data(self, img, lang, psm=6, whitelist=None):
+        time.sleep(random.uniform(0, 0.005))
+        return super(SlowBackend, self).image_to_data(img, lang, psm, whitelist)
+
+
+def setup_function(function):
+    set_backend(SlowBackend("1234\n", 90.0))
+
+
+def teardown_function(function):
+    set_backend(None)
+
+
+def testorder():
+    img = cv2.imread(file("pas1.jpg"))
+    images = [img.copy() for _ in range(6)]
+    results = list(recognise_stream(images, file("RusPass.json"), workers=3))
+    assert [r.index for r in results] == list(range(6))
+    assert all(r.source is images[r.index] and r.error is None for r in results)
+
+
+def testerrorsinorder():
+    sources = [file("pas1.jpg"), file("missing.jpg"), file("pas1.jpg")]
+    results = list(recognise_stream(sources, file("RusPass.json"), workers=2))
+    assert [r.index for r in results] == [0, 1, 2]
+    assert [r.error is None for r in results] == [True, False, True]
+
+
+def testbackpressure():
+    consumed = []
+
+    def sources():
+        for i in range(10):
+            consumed.append(i)
+            yield file("pas1.jpg")
+
+    stream = recognise_stream(sources(), file("RusPass.json"), workers=1, max_inflight=2)
+    for taken in range(1, 6):
+        next(stream)
+        time.sleep(0.05)  # Let the prefetch thread read ahead as far as it may
+        assert len(consumed) <= taken + 2
+    stream.close()
+
+
+def testearlyclose():
+    # The queue is never closed with a None: the prefetch thread stays blocked in it
+    paths = queue.Queue()
+    for _ in range(3):
+        paths.put(file("pas1.jpg"))
+    stream = recognise_stream(iter_sources(paths), file("RusPass.json"), workers=1, max_inflight=4)
+    next(stream)
+    closer = threading.Thread(target=stream.close, daemon=True)
+    closer.start()
+    closer.join(5)
+    assert not closer.is_alive()
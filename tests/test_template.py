@@ -0,0 +1,24 @@
+import copy
+import pickle
+
+import numpy as np
+from pkg_resources import resource_filename
+
+from pasportrecogniotion.util.docdescription import load_template
+
+file = lambda fn: resource_filename('tests', 'data/%s' % fn)
+
+
+def testpickle():
+    template = load_template(file("RusPass.json"))
+    for restored in (pickle.loads(pickle.dumps(template)), copy.deepcopy(template)):
+        assert restored.digest == template.digest
+        assert np.array_equal(restored.bounds, template.bounds)
+        assert [(b.name, b.bounds, b.lang, b.psm, b.whitelist) for b in restored.blocks] == \
+               [(b.name, b.bounds, b.lang, b.psm, b.whitelist) for b in template.blocks]
+
+
+def testpickleblock():
+    block = load_template(file("RusPass.json")).blocks[0].replace(posX=380)
+    restored = pickle.loads(pickle.dumps(block))
+    assert restored.posX == 380 and restored.bounds == block.bounds and restored.alt_psm == block.alt_psm